@@ -0,0 +1,305 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/28
+import copy
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+import torch
+from base.driver import logger
+from safetensors.torch import load_file, save_file
+
+MODEL_INDEX_FILE = 'model.safetensors.index.json'
+TRAINER_STATE_FILE = 'trainer_state.json'
+# the parts of a resume checkpoint, each written to its own files
+CHECKPOINT_PARTS = {
+    'model_state_dict': 'model',
+    'optimizer_state_dict': 'optimizer',
+    'scheduler_state_dict': 'scheduler',
+    'ema_state_dict': 'ema',
+    'data_loader_state': 'data_loader',
+}
+
+
+def _split_tensors(obj, key, tensors):
+    # replace the tensors of a nested state by references to their name in `tensors`
+    if isinstance(obj, torch.Tensor):
+        tensors[key] = obj
+        return {'__tensor__': key}
+    if isinstance(obj, dict):
+        return type(obj)((k, _split_tensors(v, "{}.{}".format(key, k) if key else str(k), tensors))
+                         for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(v, "{}.{}".format(key, i) if key else str(i), tensors)
+                         for i, v in enumerate(obj))
+    return obj
+
+
+def _merge_tensors(obj, tensors):
+    if isinstance(obj, dict):
+        if list(obj.keys()) == ['__tensor__']:
+            return tensors[obj['__tensor__']]
+        return type(obj)((k, _merge_tensors(v, tensors)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_merge_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _dedupe_tensors(tensors):
+    """Tensors that safetensors can write, and the names of tied tensors mapped to the name they are saved under."""
+    unique, aliases, seen, storages = {}, {}, {}, set()
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().cpu()
+        view = (tensor.untyped_storage().data_ptr(), tensor.storage_offset(), tuple(tensor.shape), tensor.stride(),
+                tensor.dtype)
+        if tensor.numel() > 0 and view in seen:
+            aliases[name] = seen[view]
+            continue
+        seen[view] = name
+        storage = tensor.untyped_storage().data_ptr()
+        if tensor.numel() > 0 and storage in storages:
+            # other views of a saved storage get their own copy
+            tensor = tensor.clone()
+        storages.add(storage)
+        unique[name] = tensor.contiguous()
+    return unique, aliases
+
+
+def _save_model_shards(model_state_dict, checkpoint_dir, max_shard_size):
+    tensors, aliases = _dedupe_tensors(model_state_dict)
+    shards, shard_size, total_size = [[]], 0, 0
+    for name, tensor in tensors.items():
+        size = tensor.numel() * tensor.element_size()
+        if shards[-1] and shard_size + size > max_shard_size:
+            shards.append([])
+            shard_size = 0
+        shards[-1].append(name)
+        shard_size += size
+        total_size += size
+    weight_map = {}
+    for i, names in enumerate(shards):
+        # a single shard keeps the name transformers looks for
+        file_name = 'model.safetensors' if len(shards) == 1 else \
+            'model-{:05d}-of-{:05d}.safetensors'.format(i + 1, len(shards))
+        save_file({name: tensors[name] for name in names}, join(checkpoint_dir, file_name),
+                  metadata={'format': 'pt'})
+        weight_map.update(dict.fromkeys(names, file_name))
+    with open(join(checkpoint_dir, MODEL_INDEX_FILE), 'w') as f:
+        json.dump({'metadata': {'total_size': total_size}, 'weight_map': weight_map, 'aliases': aliases}, f,
+                  indent=2)
+
+
+def save_sharded_checkpoint(state, checkpoint_dir, max_shard_size=2 << 30):
+    """Write a checkpoint as a directory of safetensors files.
+
+    `state` is a model state dict or a resume checkpoint holding `model_state_dict`. The model weights go to
+    `model*.safetensors` shards of at most `max_shard_size` bytes with a transformers style index, every other dict of
+    the checkpoint (optimizer, scheduler, EMA, data loader state) to `<part>.safetensors` for its tensors and
+    `<part>.pt` for the rest, and the remaining values (epoch, global_step...) to `trainer_state.json`.
+    """
+    if 'model_state_dict' not in state:
+        state = {'model_state_dict': state}
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    parts, trainer_state = {}, {}
+    for key, value in state.items():
+        if key == 'model_state_dict':
+            _save_model_shards(value, checkpoint_dir, max_shard_size)
+            parts[key] = CHECKPOINT_PARTS[key]
+        elif isinstance(value, dict):
+            part = CHECKPOINT_PARTS.get(key, key)
+            tensors = {}
+            skeleton = _split_tensors(value, '', tensors)
+            tensors, aliases = _dedupe_tensors(tensors)
+            if tensors:
+                save_file(tensors, join(checkpoint_dir, "{}.safetensors".format(part)))
+            torch.save({'skeleton': skeleton, 'aliases': aliases}, join(checkpoint_dir, "{}.pt".format(part)))
+            parts[key] = part
+        else:
+            trainer_state[key] = value
+    with open(join(checkpoint_dir, TRAINER_STATE_FILE), 'w') as f:
+        json.dump({'parts': parts, 'state': trainer_state}, f, indent=2)
+
+
+def is_sharded_checkpoint(checkpoint_path):
+    return os.path.isdir(checkpoint_path) and os.path.exists(join(checkpoint_path, MODEL_INDEX_FILE))
+
+
+def _iter_model_shards(checkpoint_dir):
+    # one memory-mapped shard at a time, tied weights point to the tensor they were saved as
+    with open(join(checkpoint_dir, MODEL_INDEX_FILE), 'r') as f:
+        index = json.load(f)
+    aliases = index.get('aliases', {})
+    for file_name in sorted(set(index['weight_map'].values())):
+        shard = load_file(join(checkpoint_dir, file_name))
+        shard.update({alias: shard[name] for alias, name in aliases.items() if name in shard})
+        yield shard
+
+
+def load_sharded_model(model, checkpoint_dir, strict=True):
+    """Load the weights of a sharded checkpoint into `model` shard by shard, return the missing and unexpected keys."""
+    expected = set(model.state_dict().keys())
+    loaded = set()
+    for shard in _iter_model_shards(checkpoint_dir):
+        model.load_state_dict(shard, strict=False)
+        loaded.update(shard.keys())
+    missing, unexpected = sorted(expected - loaded), sorted(loaded - expected)
+    if strict and (missing or unexpected):
+        raise RuntimeError("Error(s) in loading state_dict from {}: missing keys {}, unexpected keys {}".format(
+            checkpoint_dir, missing, unexpected))
+    return missing, unexpected
+
+
+def load_checkpoint(checkpoint_path, parts=None):
+    """Load a checkpoint written by torch.save or `save_sharded_checkpoint`, only `parts` of a sharded one."""
+    if not is_sharded_checkpoint(checkpoint_path):
+        return torch.load(checkpoint_path, map_location=torch.device("cpu"))
+    with open(join(checkpoint_path, TRAINER_STATE_FILE), 'r') as f:
+        trainer_state = json.load(f)
+    checkpoint = dict(trainer_state['state'])
+    for key, part in trainer_state['parts'].items():
+        if parts is not None and key not in parts:
+            continue
+        if key == 'model_state_dict':
+            checkpoint[key] = {name: tensor for shard in _iter_model_shards(checkpoint_path)
+                               for name, tensor in shard.items()}
+            continue
+        structure = torch.load(join(checkpoint_path, "{}.pt".format(part)))
+        tensors_path = join(checkpoint_path, "{}.safetensors".format(part))
+        tensors = load_file(tensors_path) if os.path.exists(tensors_path) else {}
+        tensors.update({alias: tensors[name] for alias, name in structure['aliases'].items()})
+        checkpoint[key] = _merge_tensors(structure['skeleton'], tensors)
+    return checkpoint
+
+
+def _remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class CheckpointWriter(object):
+    """Writes checkpoints from a CPU snapshot of their state, on a background thread when `async_write` is set.
+
+    `save` copies every tensor of the state into CPU buffers (pinned for CUDA tensors so the copies are
+    asynchronous) that are reused from one checkpoint to the next, then returns while the snapshot is serialized to a
+    temporary file renamed to the checkpoint path, so a checkpoint is either complete or missing. Only one write is in
+    flight, a save waits for the previous one first. With `keep_top_k`, only the k checkpoints with the best metric
+    (the highest for mode "max") are kept on disk, checkpoints saved without a metric are never removed. With
+    `save_format` "safetensors", checkpoints are directories written by `save_sharded_checkpoint`, named after the
+    checkpoint path without its extension.
+    """
+
+    def __init__(self, async_write=True, keep_top_k=None, mode="max", pin_memory=True, save_format="pth",
+                 max_shard_size=2 << 30):
+        assert mode in ("max", "min"), "mode should be max or min, got {}".format(mode)
+        assert save_format in ("pth", "safetensors"), "unknown checkpoint format {}".format(save_format)
+        self.save_format = save_format
+        self.max_shard_size = max_shard_size
+        self.async_write = async_write
+        self.keep_top_k = keep_top_k
+        self.mode = mode
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self.executor = ThreadPoolExecutor(max_workers=1) if async_write else None
+        self.pending = None
+        self.buffers = {}
+        self.saved = []
+
+    def _buffer(self, key, tensor):
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, device="cpu",
+                                 pin_memory=self.pin_memory and tensor.is_cuda)
+            self.buffers[key] = buffer
+        return buffer
+
+    def _snapshot(self, obj, key, memo):
+        if isinstance(obj, torch.Tensor):
+            # state_dict() returns a new tensor for every name, tied weights are told apart by the memory they view:
+            # they share their snapshot like they share their storage, and are written once
+            view = (obj.device, obj.data_ptr(), obj.dtype, tuple(obj.shape), obj.stride())
+            if obj.numel() == 0:
+                view = id(obj)
+            if view not in memo:
+                memo[view] = self._buffer(key, obj).copy_(obj.detach(), non_blocking=obj.is_cuda)
+            return memo[view]
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, key + (k,), memo)) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,), memo) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def save(self, state, checkpoint_path, metric=None):
+        """Snapshot `state` and write it, return the checkpoint path and the seconds training was blocked for."""
+        if self.save_format == "safetensors":
+            checkpoint_path = os.path.splitext(checkpoint_path)[0]
+        start = time.time()
+        self.wait()
+        snapshot = self._snapshot(state, (), {})
+        copied = None
+        if torch.cuda.is_available():
+            # the write waits for the device to host copies, later in-place updates are ordered after them
+            copied = torch.cuda.current_stream().record_event()
+        snapshot_time = time.time() - start
+        if self.async_write:
+            self.pending = self.executor.submit(self._write, snapshot, checkpoint_path, metric, copied, snapshot_time)
+        else:
+            self._write(snapshot, checkpoint_path, metric, copied, snapshot_time)
+        return checkpoint_path, snapshot_time
+
+    def _write(self, snapshot, checkpoint_path, metric, copied, snapshot_time):
+        if copied is not None:
+            copied.synchronize()
+        start = time.time()
+        tmp_path = "{}.tmp".format(checkpoint_path)
+        try:
+            if self.save_format == "safetensors":
+                _remove(tmp_path)
+                save_sharded_checkpoint(snapshot, tmp_path, self.max_shard_size)
+                _remove(checkpoint_path)
+            else:
+                with open(tmp_path, "wb") as f:
+                    torch.save(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, checkpoint_path)
+        except Exception:
+            logger.exception("failed to write checkpoint {}".format(checkpoint_path))
+            _remove(tmp_path)
+            return
+        write_time = time.time() - start
+        logger.info("checkpoint {} written in {:.2f}s, training blocked {:.2f}s for the snapshot".format(
+            checkpoint_path, write_time, snapshot_time))
+        self._remove_worse_checkpoints(checkpoint_path, metric)
+
+    def _remove_worse_checkpoints(self, checkpoint_path, metric):
+        if self.keep_top_k is None or metric is None:
+            return
+        self.saved = [(m, path) for m, path in self.saved if path != checkpoint_path] + [(metric, checkpoint_path)]
+        self.saved.sort(key=lambda item: item[0], reverse=self.mode == "max")
+        for _, path in self.saved[self.keep_top_k:]:
+            if os.path.exists(path):
+                _remove(path)
+                logger.info("remove checkpoint {} out of the top {}".format(path, self.keep_top_k))
+        self.saved = self.saved[:self.keep_top_k]
+
+    def set_metric(self, checkpoint_path, metric):
+        """Rank a checkpoint saved without a metric, once it is known (after an asynchronous evaluation)."""
+        if self.async_write:
+            # after the checkpoint's own write, on the writer thread
+            self.executor.submit(self._remove_worse_checkpoints, checkpoint_path, metric)
+        else:
+            self._remove_worse_checkpoints(checkpoint_path, metric)
+
+    def wait(self):
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -28,6 +28,25 @@ def seed_all(random_seed):
         torch.backends.cudnn.deterministic = True
 
 
+def get_rng_state():
+    rng_state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_state['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_state
+
+
+def set_rng_state(rng_state):
+    random.setstate(rng_state['python'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if 'cuda' in rng_state and torch.cuda.is_available() and len(rng_state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
 def print_network(net, verbose=False, name=""):
     num_params = 0
     for param in net.parameters():
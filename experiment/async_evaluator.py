@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/30
+import atexit
+import copy
+import os
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from base.driver import logger
+
+
+def _evaluation_worker(experiment_type, config, device, weights, requests, results):
+    # the process builds its own experiment: model, processor and eval data loader, without trainer nor accelerator
+    os.environ["RUN_ON_GPU_IDs"] = str(device)
+    config = copy.deepcopy(config)
+    config['phase'] = 'predict'
+    config['model']['model_path'] = None
+    import experiment
+    evaluator = getattr(experiment, experiment_type)(config)
+    evaluator.model.eval()
+    while True:
+        info = requests.get()
+        if info is None:
+            break
+        evaluator.model.load_state_dict(weights)
+        results.put((info, evaluator.evaluate()))
+
+
+class AsyncEvaluator(object):
+    """Evaluates snapshots of the model weights in a separate process while training goes on.
+
+    The process builds the experiment once, with the same config in the predict phase, on the GPU `device` (-1 for
+    the CPU). The weights are exchanged through a copy of the model state dict in shared memory: `submit` copies the
+    current weights into it and returns, the process loads them and runs `evaluate` on the whole eval set, and `poll`
+    returns the results of the evaluations that finished. One evaluation runs at a time, `submit` returns False while
+    the previous one is still running.
+    """
+
+    def __init__(self, experiment_type, config, model, device):
+        context = mp.get_context("spawn")
+        memo = {}
+        self.weights = {}
+        for name, tensor in model.state_dict().items():
+            # tied weights view the same memory under different names, they share their buffer
+            view = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+            if tensor.numel() == 0:
+                view = name
+            if view not in memo:
+                memo[view] = tensor.detach().cpu().clone().share_memory_()
+            self.weights[name] = memo[view]
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        # not a daemon, the eval data loader starts its own workers
+        self.process = context.Process(target=_evaluation_worker, args=(
+            experiment_type, config, device, self.weights, self.requests, self.results))
+        self.process.start()
+        self.busy = False
+        atexit.register(self.close, wait=False)
+        logger.info("start evaluation process {} on device {}".format(self.process.pid, device))
+
+    def submit(self, model, **info):
+        """Evaluate the current weights of `model`, `info` is returned with the result."""
+        if self.busy:
+            return False
+        with torch.no_grad():
+            for name, tensor in model.state_dict().items():
+                self.weights[name].copy_(tensor)
+        self.requests.put(info)
+        self.busy = True
+        return True
+
+    def poll(self, wait=False):
+        """(info, result) of the finished evaluations, waits for the running one with `wait`."""
+        finished = []
+        while self.busy:
+            try:
+                finished.append(self.results.get(timeout=10) if wait else self.results.get_nowait())
+                self.busy = False
+            except queue.Empty:
+                if not self.process.is_alive():
+                    logger.error("the evaluation process exited with code {}".format(self.process.exitcode))
+                    self.busy = False
+                elif not wait:
+                    break
+        return finished
+
+    def close(self, wait=True):
+        if not self.process.is_alive():
+            return
+        if wait:
+            self.requests.put(None)
+            self.process.join()
+        else:
+            self.process.terminate()
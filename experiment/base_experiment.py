@@ -19,7 +19,10 @@ import mydatasets
 from mydatasets import get_dataset
 from base.common_util import get_absolute_file_path, merge_config, save_params
 from base.driver import log_formatter, logger
-from base.torch_utils.dl_util import get_optimizer, get_scheduler, get_scheduler2, seed_all, get_grad_norm
+from base.torch_utils.dl_util import get_optimizer, get_scheduler, get_scheduler2, seed_all, get_grad_norm, \
+    get_rng_state, set_rng_state
+from base.torch_utils.checkpoint_util import CheckpointWriter, is_sharded_checkpoint, load_checkpoint, \
+    load_sharded_model
 from base.torch_utils.torch_util import ModelEMA
 
 
@@ -220,17 +223,31 @@ class BaseExperiment(object):
             self.args.trainer.best_eval_result = -1
             self.args.trainer.best_model_path = ''
             self.ema = ModelEMA(self.model) if trainer_args['use_ema'] else None
+            checkpoint_args = trainer_args.get("checkpoint") or {}
+            self.checkpoint_writer = CheckpointWriter(async_write=checkpoint_args.get("async_write", True),
+                                                      keep_top_k=checkpoint_args.get("keep_top_k"),
+                                                      mode=checkpoint_args.get("mode", "max"),
+                                                      save_format=checkpoint_args.get("format", "pth"),
+                                                      max_shard_size=checkpoint_args.get("max_shard_size", 2 << 30))
             self.args.trainer.start_epoch = 0
             self.args.trainer.start_global_step = 0
+            self.args.trainer.start_batch = 0
             if self.args.trainer.resume_flag and 'model_path' in self.args.model and self.args.model.model_path is not None:
                 # ADD resume
                 resume_path = self.args.model.model_path.replace('.pth', '_resume.pth')
                 if os.path.exists(resume_path):
-                    resume_checkpoint = torch.load(resume_path)
+                    # the model weights were loaded by init_model
+                    resume_checkpoint = load_checkpoint(resume_path, parts=(
+                        'optimizer_state_dict', 'scheduler_state_dict', 'ema_state_dict', 'data_loader_state'))
                     self.optimizer.load_state_dict(resume_checkpoint['optimizer_state_dict'])
                     self.scheduler.load_state_dict(resume_checkpoint['scheduler_state_dict'])
+                    if self.ema is not None and 'ema_state_dict' in resume_checkpoint:
+                        self.ema.ema.load_state_dict(resume_checkpoint['ema_state_dict'])
+                        self.ema.updates = resume_checkpoint.get('ema_updates', 0)
                     self.args.trainer.start_epoch = resume_checkpoint['epoch']
                     self.args.trainer.start_global_step = resume_checkpoint['global_step']
+                    if resume_checkpoint.get('data_loader_state') is not None:
+                        self._load_data_loader_state(resume_checkpoint['data_loader_state'])
                 else:
                     logger.warning("resume path {} doesn't exist: failed to resume!!".format(resume_path))
 
@@ -253,10 +270,15 @@ class BaseExperiment(object):
                                    self.train_data_loader.batch_size * num_process
         self.optimizer = get_optimizer(self.model, **optimizer_args)
 
+    def _get_epoch_train_steps(self):
+        # the batches of an epoch over all the processes: accelerate steps a prepared scheduler once per process at
+        # every optimizer step
+        return len(self.train_data_loader)
+
     def _init_scheduler(self, trainer_args, **kwargs):
         scheduler_args = trainer_args.get("scheduler")
         self.args.trainer.scheduler_by_epoch = scheduler_args.get("scheduler_by_epoch", False)
-        total_epoch_train_steps = len(self.train_data_loader)
+        total_epoch_train_steps = self._get_epoch_train_steps()
         if scheduler_args["warmup_epochs"] > 0:
             warmup_steps = scheduler_args.get("warmup_epochs") * total_epoch_train_steps
         elif scheduler_args['warmup_steps'] > 0:
@@ -294,7 +316,11 @@ class BaseExperiment(object):
     """
 
     def load_model(self, checkpoint_path, strict=True, **kwargs):
-        if os.path.exists(checkpoint_path) and os.path.isfile(checkpoint_path):
+        if is_sharded_checkpoint(checkpoint_path):
+            # shard by shard from memory maps, never holding a second copy of the whole model
+            load_sharded_model(self.model, checkpoint_path, strict=strict)
+            logger.info("success load model:{}".format(checkpoint_path))
+        elif os.path.exists(checkpoint_path) and os.path.isfile(checkpoint_path):
             state_dict = torch.load(checkpoint_path, map_location=torch.device("cpu"))
             if 'model_state_dict' in state_dict:
                 model_state_dict = state_dict['model_state_dict']
@@ -303,34 +329,74 @@ class BaseExperiment(object):
             self.model.load_state_dict(model_state_dict, strict=strict)
             logger.info("success load model:{}".format(checkpoint_path))
 
-    def save_model(self, checkpoint_path, **save_kwargs):
+    def _get_data_loader_state(self, epoch, global_step):
+        # global_step counts every batch of the previous epochs, the rest is the position within `epoch`
+        num_batches = len(self.train_data_loader)
+        batch_sampler = self.train_data_loader.batch_sampler
+        return {
+            'epoch': epoch,
+            'batch': global_step - epoch * num_batches,
+            'num_batches': num_batches,
+            'batch_sampler': batch_sampler.state_dict() if hasattr(batch_sampler, 'state_dict') else None,
+            'rng_state': get_rng_state(),
+        }
+
+    def _load_data_loader_state(self, data_loader_state):
+        batch_sampler = self.train_data_loader.batch_sampler
+        if data_loader_state['batch_sampler'] is None or not hasattr(batch_sampler, 'load_state_dict'):
+            logger.warning("the train data loader can't seek, resume by skipping {} batches".format(
+                self.args.trainer.start_global_step))
+            return
+        if data_loader_state['num_batches'] != len(self.train_data_loader):
+            logger.warning("the train data loader has {} batches instead of {}, resume by skipping batches".format(
+                len(self.train_data_loader), data_loader_state['num_batches']))
+            return
+        batch_sampler.load_state_dict(data_loader_state['batch_sampler'])
+        set_rng_state(data_loader_state['rng_state'])
+        epoch, batch = data_loader_state['epoch'], data_loader_state['batch']
+        if batch >= data_loader_state['num_batches']:
+            # saved at the end of an epoch
+            epoch, batch = epoch + 1, 0
+        self.args.trainer.start_epoch = epoch
+        self.args.trainer.start_batch = batch
+        logger.info("resume from epoch {} batch {}".format(epoch, batch))
+
+    def _get_resume_state(self, model, **save_kwargs):
+        save_kwargs.update({
+            'model_state_dict': model.state_dict(),
+            'optimizer_state_dict': self.optimizer.state_dict(),
+            'scheduler_state_dict': self.scheduler.state_dict(),
+        })
+        if getattr(self, "ema", None) is not None:
+            save_kwargs.update({'ema_state_dict': self.ema.ema.state_dict(), 'ema_updates': self.ema.updates})
+        return save_kwargs
+
+    def save_model(self, checkpoint_path, metric=None, **save_kwargs):
+        if self.args.trainer.resume_flag and 'epoch' in save_kwargs and 'global_step' in save_kwargs:
+            save_kwargs['data_loader_state'] = self._get_data_loader_state(save_kwargs['epoch'],
+                                                                           save_kwargs['global_step'])
         if self.accelerator is not None:
             unwrapped_model = self.accelerator.unwrap_model(self.model)
             if self.args.trainer.resume_flag:
-                save_kwargs.update({
-                    'model_state_dict': unwrapped_model.state_dict(),
-                    'optimizer_state_dict': self.optimizer.state_dict(),
-                    'scheduler_state_dict': self.scheduler.state_dict(),
-                })
-                self.accelerator.save(save_kwargs, checkpoint_path.replace('.pth', '.ckpt'))
+                state = self._get_resume_state(unwrapped_model, **save_kwargs)
+                checkpoint_path = checkpoint_path.replace('.pth', '.ckpt')
             else:
-                self.accelerator.save(unwrapped_model.state_dict(), checkpoint_path)
+                state = unwrapped_model.state_dict()
         else:
             if self.args.model.quantization_type == 'quantization_aware_training':
                 self.model.eval()
                 model_int8 = torch.quantization.convert(self.model)
-                torch.save(model_int8.state_dict(), checkpoint_path)
+                state = model_int8.state_dict()
             else:
                 if self.args.trainer.resume_flag:
-                    save_kwargs.update({
-                        'model_state_dict': self.model.state_dict(),
-                        'optimizer_state_dict': self.optimizer.state_dict(),
-                        'scheduler_state_dict': self.scheduler.state_dict(),
-                    })
-                    torch.save(save_kwargs, checkpoint_path.replace('.pth', '.ckpt'))
+                    state = self._get_resume_state(self.model, **save_kwargs)
+                    checkpoint_path = checkpoint_path.replace('.pth', '.ckpt')
                 else:
-                    torch.save(self.model.state_dict(), checkpoint_path)
-        logger.info("model successfully saved to {}".format(checkpoint_path))
+                    state = self.model.state_dict()
+        # training goes on once the state is copied to the host, the file is written in the background
+        checkpoint_path, snapshot_time = self.checkpoint_writer.save(state, checkpoint_path, metric=metric)
+        logger.info("model snapshot taken in {:.2f}s, saving to {}".format(snapshot_time, checkpoint_path))
+        return checkpoint_path
 
     def _get_data_loader_from_dataset(self, dataset, data_loader_args, phase="train"):
         num_workers = data_loader_args.get("num_workers", 0)
@@ -364,6 +430,8 @@ class BaseExperiment(object):
                 self.model, self.optimizer, self.train_data_loader, self.scheduler)
 
     def _train_post_process(self):
+        # wait for the last checkpoint to be written
+        self.checkpoint_writer.close()
         args = copy.deepcopy(self.args)
         args.model.model_path = args.trainer.best_model_path
         if 'base' in args:
@@ -400,7 +468,8 @@ class BaseExperiment(object):
                     self.experiment_name, epoch, global_step, current_lr, loss_meter.avg, acc)
                 checkpoint_path = os.path.join(self.args.trainer.save_dir, checkpoint_name)
                 # ADD记得传epoch和global_step，resume才能存
-                self.save_model(checkpoint_path, epoch=epoch, global_step=global_step, loss=loss_meter.val)
+                checkpoint_path = self.save_model(checkpoint_path, metric=acc, epoch=epoch, global_step=global_step,
+                                                  loss=loss_meter.val)
                 if acc > self.args.trainer.best_eval_result:
                     self.args.trainer.best_eval_result = acc
                     self.args.trainer.best_model_path = checkpoint_path
@@ -420,7 +489,8 @@ class BaseExperiment(object):
                     self.experiment_name, epoch, global_step, current_lr, loss_meter.avg, acc)
                 checkpoint_path = os.path.join(self.args.trainer.save_dir, checkpoint_name)
                 # ADD记得传epoch和global_step，resume才能存
-                self.save_model(checkpoint_path, epoch=epoch, global_step=global_step, loss=loss_meter.val)
+                checkpoint_path = self.save_model(checkpoint_path, metric=acc, epoch=epoch, global_step=global_step,
+                                                  loss=loss_meter.val)
                 if acc > self.args.trainer.best_eval_result:
                     self.args.trainer.best_eval_result = acc
                     self.args.trainer.best_model_path = checkpoint_path
@@ -1,14 +1,17 @@
 # -*- coding:utf-8 -*-
 # create: 2023/6/2
+import copy
 import time
 import munch
 import os
+import numpy as np
 import torch
 import mydatasets
 from Levenshtein import distance
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from tqdm import tqdm
-from mydatasets import get_dataset
+from mydatasets import get_dataset, normalize_pixel_values
+from .async_evaluator import AsyncEvaluator
 from .base_experiment import BaseExperiment
 from metrics import AverageMeter, TokenAccMetric
 from base.driver import logger
@@ -22,6 +25,8 @@ class DonutExperiment(BaseExperiment):
 
     def __init__(self, config):
         config = self._init_config(config)
+        # the config as loaded, for the asynchronous evaluation process
+        self.raw_config = copy.deepcopy(config)
         self.experiment_name = config["name"]
         self.args = munch.munchify(config)
         self.init_device(config)
@@ -36,21 +41,27 @@ class DonutExperiment(BaseExperiment):
         Main Block
     """
 
-    def evaluate(self, **kwargs):
+    def evaluate(self, data_loader=None, **kwargs):
+        data_loader = data_loader or self.eval_data_loader
+        # generate bypasses the DDP wrapper, ranks can run different numbers of eval batches
+        model = self.model if self.accelerator is None else self.accelerator.unwrap_model(self.model)
         edit_distance = AverageMeter()
         eval_metric = TokenAccMetric(pad_token_id=self.processor.tokenizer.pad_token_id,
                                      eos_token_id=self.processor.tokenizer.eos_token_id)
-        for i, batch_data in tqdm(enumerate(self.eval_data_loader), total=len(self.eval_data_loader)):
+        for i, batch_data in tqdm(enumerate(data_loader), total=len(data_loader)):
             pixel_values = torch.stack([instance for instance in batch_data['pixel_values']])
+            pixel_values = pixel_values.to(self.args.device.device_id)
+            if pixel_values.dtype == torch.uint8:
+                pixel_values = normalize_pixel_values(pixel_values, self.processor.image_processor)
             answers = batch_data['processed_parse']
             batch_size = pixel_values.shape[0]
-            decoder_input_ids = torch.full((batch_size, 1), self.model.config.decoder_start_token_id)
+            decoder_input_ids = torch.full((batch_size, 1), model.config.decoder_start_token_id)
             start = time.time()
             with torch.no_grad():
-                outputs = self.model.generate(
-                    pixel_values.to(self.args.device.device_id),
+                outputs = model.generate(
+                    pixel_values,
                     decoder_input_ids=decoder_input_ids.to(self.args.device.device_id),
-                    max_length=self.model.decoder.config.max_length,
+                    max_length=model.decoder.config.max_length,
                     pad_token_id=self.processor.tokenizer.pad_token_id,
                     eos_token_id=self.processor.tokenizer.eos_token_id,
                     use_cache=True,
@@ -60,7 +71,8 @@ class DonutExperiment(BaseExperiment):
                 )
             batch_time = time.time() - start
             logger.info("batch inference time:{} s".format(batch_time))
-            eval_metric.add(outputs.sequences[:, 1:].cpu(), batch_data['labels'].cpu())
+            # counted on the device, without waiting for it
+            eval_metric.add(outputs.sequences[:, 1:], batch_data['labels'])
             pred_sequences = self.processor.tokenizer.batch_decode(outputs.sequences)
             for ans_seq, pred_seq in zip(answers, pred_sequences):
                 pred_seq = pred_seq.replace(self.processor.tokenizer.bos_token, "") \
@@ -68,20 +80,38 @@ class DonutExperiment(BaseExperiment):
                     replace(self.processor.tokenizer.pad_token, "")
                 if len(ans_seq) > 0:
                     edit_distance.update(distance(pred_seq, ans_seq) / len(ans_seq))
+        edit_distance_sum, edit_distance_count = edit_distance.sum, edit_distance.count
+        if self.accelerator is not None and self.accelerator.num_processes > 1:
+            # every rank evaluated its shard of the eval set, the metrics are computed from the summed counts
+            eval_metric.all_reduce(device=self.args.device.device_id)
+            totals = torch.tensor([edit_distance_sum, edit_distance_count], dtype=torch.float64,
+                                  device=self.args.device.device_id)
+            edit_distance_sum, edit_distance_count = self.accelerator.reduce(totals, reduction="sum").tolist()
+        token_acc = eval_metric.mean()
+        edit_dis = edit_distance_sum / edit_distance_count if edit_distance_count > 0 else 0
         logger.info("evaluating...")
-        logger.info("token_acc: {}; edit_dis: {}".format(eval_metric.mean(), edit_distance.avg))
-        return {"token_acc": eval_metric.mean(), "edit_dis": edit_distance.avg}
+        logger.info("token_acc: {}; edit_dis: {}".format(token_acc, edit_dis))
+        return {"token_acc": token_acc, "edit_dis": edit_dis}
 
     def train(self, **kwargs):
         batch_time = AverageMeter()
         loss_meter = AverageMeter()
         norm_meter = AverageMeter()
-        global_step = self.args.trainer.start_epoch * len(self.train_data_loader)
+        start_batch = self.args.trainer.get("start_batch", 0)
+        global_step = self.args.trainer.start_epoch * len(self.train_data_loader) + start_batch
         global_eval_step = 0
         ni = 0
         for epoch in range(self.args.trainer.start_epoch, self.args.trainer.epochs):
+            batch_sampler = self.train_data_loader.batch_sampler
+            if hasattr(batch_sampler, "set_epoch"):
+                batch_sampler.set_epoch(epoch)
+            if epoch > self.args.trainer.start_epoch or not hasattr(batch_sampler, "set_start_batch"):
+                start_batch = 0
+            # resume in the middle of the epoch without loading the batches already trained on
+            if start_batch > 0:
+                batch_sampler.set_start_batch(start_batch)
             self.optimizer.zero_grad()
-            for i, batch in enumerate(self.train_data_loader):
+            for i, batch in enumerate(self.train_data_loader, start_batch):
                 if global_step < self.args.trainer.start_global_step:
                     global_step += 1
                     continue
@@ -111,7 +141,13 @@ class DonutExperiment(BaseExperiment):
 
     def _step_forward(self, batch, is_train=True, eval_model=None, **kwargs):
         input_args_list = ['pixel_values', 'labels', 'decoder_input_ids']
+        image_boxes = batch.get('image_boxes')
         batch = {k: v.to(self.args.device.device_id) for k, v in batch.items() if k in input_args_list}
+        if is_train and self.batch_augmentation is not None and self.batch_augmentation_device != "cpu":
+            batch['pixel_values'] = self.batch_augmentation(batch['pixel_values'], image_boxes)
+        if batch['pixel_values'].dtype == torch.uint8:
+            # the collate function left normalization to the device
+            batch['pixel_values'] = normalize_pixel_values(batch['pixel_values'], self.processor.image_processor)
         # Runs the forward pass with auto-casting.
         with self.precision_scope:
             output = self.model(**batch)
@@ -155,11 +191,41 @@ class DonutExperiment(BaseExperiment):
         optimizer_args = trainer_args.get("optimizer")
         if optimizer_args.get("scale_lr"):
             num_process = 1 if self.accelerator is None else self.accelerator.num_processes
-            optimizer_args['lr'] = float(optimizer_args['lr']) * self.grad_accumulate * \
-                                   self.train_data_loader.batch_size * num_process
+            # a token budget batch sampler leaves the data loader without a batch_size
+            batch_size = self.train_data_loader.batch_size or self.args.datasets.train.batch_size
+            optimizer_args['lr'] = float(optimizer_args['lr']) * self.grad_accumulate * batch_size * num_process
         self.optimizer = get_optimizer(self.model, **optimizer_args)
 
+    def init_evaluator_args(self, config):
+        super().init_evaluator_args(config)
+        evaluation_args = config.get('trainer', {}).get('evaluation') or {}
+        # sync: the whole eval set in the training loop, subset: a fixed random subset of it in the training loop,
+        # async: the whole eval set in a separate process while training goes on
+        self.eval_mode = evaluation_args.get('mode', 'sync')
+        self.eval_subset_data_loader = None
+        self.async_evaluator = None
+        if config.get('phase', 'train') != 'train' or not hasattr(self, 'eval_data_loader'):
+            return
+        if self.eval_mode == 'subset':
+            subset_size = min(evaluation_args.get('subset_size', 1000), len(self.eval_dataset))
+            rng = np.random.default_rng(self.args.trainer.get("random_seed") or 0)
+            indices = np.sort(rng.choice(len(self.eval_dataset), subset_size, replace=False)).tolist()
+            self.eval_subset_data_loader = DataLoader(Subset(self.eval_dataset, indices),
+                                                      sampler=self._get_eval_sampler(subset_size),
+                                                      batch_size=self.eval_data_loader.batch_size,
+                                                      num_workers=self.eval_data_loader.num_workers,
+                                                      collate_fn=self.eval_data_loader.collate_fn)
+            logger.info("evaluate on a subset of {} eval samples while training".format(subset_size))
+        elif self.eval_mode == 'async' and self.args.device.is_master:
+            device = evaluation_args.get('device')
+            if device is None:
+                # the GPU the master trains on
+                device_id = self.args.device.device_id
+                device = (device_id.index or 0) if device_id.type == 'cuda' else -1
+            self.async_evaluator = AsyncEvaluator(type(self).__name__, self.raw_config, self.model, device)
+
     def init_dataset(self, config):
+        self.batch_augmentation, self.batch_augmentation_device = None, None
         if 'datasets' in config:
             dataset_args = config.get("datasets")
             train_data_loader_args = dataset_args.get("train")
@@ -169,6 +235,10 @@ class DonutExperiment(BaseExperiment):
                     "max_length": config['model']['max_length'],
                     "phase": 'train',
                 })
+                self._init_batch_augmentation(train_data_loader_args)
+                if self.batch_augmentation is not None:
+                    # the batch augmentation replaces the albumentations transforms of the dataset
+                    train_data_loader_args['dataset'].update({"augment": False})
                 if "cache_dir" not in train_data_loader_args['dataset']:
                     train_data_loader_args['dataset'].update({
                         "cache_dir": config['trainer']['save_dir']})
@@ -201,6 +271,16 @@ class DonutExperiment(BaseExperiment):
         Tool Functions
     """
 
+    def _init_batch_augmentation(self, data_loader_args):
+        augmentation_args = dict(data_loader_args.get("batch_augmentation") or {})
+        augmentation_type = augmentation_args.pop("type", None)
+        if augmentation_type is None:
+            return
+        # "train": on the training device after collation, "cpu": in the collate function of the data loader workers
+        self.batch_augmentation_device = augmentation_args.pop("device", "train")
+        self.batch_augmentation = getattr(mydatasets, augmentation_type)(**augmentation_args)
+        logger.info("use batch augmentation {} on {}".format(augmentation_type, self.batch_augmentation_device))
+
     def _get_data_loader_from_dataset(self, dataset, data_loader_args, phase="train"):
         num_workers = data_loader_args.get("num_workers", 0)
         batch_size = data_loader_args.get("batch_size", 1)
@@ -215,10 +295,46 @@ class DonutExperiment(BaseExperiment):
             collate_fn = None
         else:
             collate_fn_type = collate_fn_args.get("type")
+            collate_fn_args = dict(collate_fn_args)
+            if phase == "train" and self.batch_augmentation is not None:
+                if self.batch_augmentation_device == "cpu":
+                    collate_fn_args["augmentation"] = self.batch_augmentation
+                else:
+                    # augmented in _step_forward before normalization
+                    collate_fn_args["uint8_pixel_values"] = True
             collate_fn = getattr(mydatasets, collate_fn_type)(batch_size=batch_size, processor=self.processor,
                                                               **collate_fn_args)
+        if phase == "train":
+            # batches are sharded over the processes by the batch sampler itself, which can also seek to any batch
+            # of an epoch when resuming
+            batch_sampler_args = dict(data_loader_args.get("batch_sampler") or {})
+            batch_sampler_type = batch_sampler_args.pop("type", None)
+            sampler_args = dict(
+                shuffle=shuffle,
+                seed=self.args.trainer.get("random_seed") or 0,
+                num_replicas=1 if self.accelerator is None else self.accelerator.num_processes,
+                rank=0 if self.accelerator is None else self.accelerator.process_index)
+            if batch_sampler_type is None:
+                batch_sampler_type = "SeededBatchSampler"
+                batch_sampler = mydatasets.SeededBatchSampler(len(dataset), batch_size, **sampler_args)
+            else:
+                # batches bounded by a label token budget, and by batch_size images for the encoder memory
+                if batch_sampler_args.get("max_batch_size") is None:
+                    batch_sampler_args["max_batch_size"] = batch_size
+                batch_sampler = getattr(mydatasets, batch_sampler_type)(dataset.token_lengths, **sampler_args,
+                                                                        **batch_sampler_args)
+            data_loader = DataLoader(dataset,
+                                     batch_sampler=batch_sampler,
+                                     num_workers=num_workers,
+                                     pin_memory=pin_memory,
+                                     collate_fn=collate_fn)
+            logger.info("use data loader with {}:{},batch_size:{},num_workers:{}".format(
+                batch_sampler_type, batch_sampler_args, batch_size, num_workers))
+            return data_loader
+        sampler = self._get_eval_sampler(len(dataset))
         data_loader = DataLoader(dataset,
-                                 shuffle=shuffle,
+                                 shuffle=shuffle if sampler is None else False,
+                                 sampler=sampler,
                                  num_workers=num_workers,
                                  pin_memory=pin_memory,
                                  collate_fn=collate_fn,
@@ -227,8 +343,83 @@ class DonutExperiment(BaseExperiment):
 
         return data_loader
 
+    def _get_eval_sampler(self, num_samples):
+        # evaluation runs on every process, each on its own shard of the eval set
+        if self.accelerator is None or self.accelerator.num_processes == 1:
+            return None
+        return mydatasets.ShardSampler(num_samples, num_replicas=self.accelerator.num_processes,
+                                       rank=self.accelerator.process_index)
+
+    def _get_epoch_train_steps(self):
+        batch_sampler = self.train_data_loader.batch_sampler
+        if isinstance(batch_sampler, mydatasets.ResumableBatchSampler):
+            # the data loader only holds the batches of this process
+            return len(batch_sampler) * batch_sampler.num_replicas
+        return super()._get_epoch_train_steps()
+
+    def prepare_accelerator(self):
+        if self.accelerator is not None and hasattr(self, "train_data_loader") and \
+                isinstance(self.train_data_loader.batch_sampler, mydatasets.ResumableBatchSampler):
+            # the batch sampler already shards batches over the processes, accelerate must not shard them again;
+            # batches are moved to the device in _step_forward
+            self.model, self.optimizer, self.scheduler = self.accelerator.prepare(
+                self.model, self.optimizer, self.scheduler)
+        else:
+            super().prepare_accelerator()
+
+    def _evaluate_and_save(self, epoch, global_step, current_lr, loss_meter, wait_eval=False):
+        message = "experiment:{}; eval, (epoch: {}, steps: {});".format(self.experiment_name, epoch, global_step)
+        logger.info(message)
+        if self.async_evaluator is not None:
+            # with wait_eval (at the end of an epoch) the running evaluation is waited for, so that this checkpoint
+            # is evaluated as well
+            self._log_async_eval_results(wait=wait_eval)
+            # the checkpoint is ranked when its evaluation finishes
+            checkpoint_name = "{}_epoch{}_step{}_lr{:e}_avg_loss{:.5f}.pth".format(
+                self.experiment_name, epoch, global_step, current_lr, loss_meter.avg)
+            checkpoint_path = os.path.join(self.args.trainer.save_dir, checkpoint_name)
+            checkpoint_path = self.save_model(checkpoint_path, epoch=epoch, global_step=global_step,
+                                              loss=loss_meter.val)
+            model = self.model if self.accelerator is None else self.accelerator.unwrap_model(self.model)
+            if not self.async_evaluator.submit(model, global_step=global_step, checkpoint_path=checkpoint_path):
+                # still saved as a resume point, without a metric it is never pruned by keep_top_k
+                logger.warning("the previous evaluation is still running, step {} is not evaluated and its "
+                               "checkpoint {} is not ranked".format(global_step, checkpoint_path))
+            return
+        result = self.evaluate(data_loader=self.eval_subset_data_loader)
+        if not self.args.device.is_master:
+            return
+        self._log_eval_result(result, global_step)
+        checkpoint_name = "{}_epoch{}_step{}_lr{:e}_avg_loss{:.5f}_token_acc{:.5f}_edit_dis{:.5f}.pth".format(
+            self.experiment_name, epoch, global_step, current_lr,
+            loss_meter.avg, result["token_acc"], result["edit_dis"])
+        checkpoint_path = os.path.join(self.args.trainer.save_dir, checkpoint_name)
+        self.save_model(checkpoint_path, metric=result["token_acc"], epoch=epoch, global_step=global_step,
+                        loss=loss_meter.val)
+
+    def _log_eval_result(self, result, global_step):
+        if self.writer is not None:
+            self.writer.add_scalar("{}_eval/token_acc".format(self.experiment_name), result["token_acc"], global_step)
+            self.writer.add_scalar("{}_eval/edit_dis".format(self.experiment_name), result["edit_dis"], global_step)
+
+    def _log_async_eval_results(self, wait=False):
+        for info, result in self.async_evaluator.poll(wait=wait):
+            logger.info("experiment:{}; eval of step {} finished, token_acc: {}; edit_dis: {}; checkpoint: {}".format(
+                self.experiment_name, info['global_step'], result["token_acc"], result["edit_dis"],
+                info['checkpoint_path']))
+            self._log_eval_result(result, info['global_step'])
+            self.checkpoint_writer.set_metric(info['checkpoint_path'], result["token_acc"])
+
+    def _train_post_process(self):
+        if self.async_evaluator is not None:
+            self._log_async_eval_results(wait=True)
+            self.async_evaluator.close()
+        super()._train_post_process()
+
     def _print_step_log(self, epoch, global_step, global_eval_step, loss_meter, norm_meter, batch_time, ni, **kwargs):
         current_lr = self._get_current_lr(ni, global_step)
+        if self.async_evaluator is not None:
+            self._log_async_eval_results()
         if self.args.device.is_master and self.args.trainer.print_freq > 0 and global_step % self.args.trainer.print_freq == 0:
             message = "experiment:{}; train, (epoch: {}, steps: {}, lr:{:e}, step_mean_loss:{}," \
                       " average_loss:{}), time, (train_step_time: {:.5f}s, train_average_time: {:.5f}s);" \
@@ -242,26 +433,15 @@ class DonutExperiment(BaseExperiment):
                 self.writer.add_scalar("{}_train/step_loss".format(self.experiment_name), loss_meter.val, global_step)
                 self.writer.add_scalar("{}_train/average_loss".format(self.experiment_name), loss_meter.avg,
                                        global_step)
-        if global_step > 0 and self.args.trainer.save_step_freq > 0 and self.args.device.is_master and global_step % self.args.trainer.save_step_freq == 0:
-            message = "experiment:{}; eval, (epoch: {}, steps: {});".format(self.experiment_name, epoch, global_step)
-            logger.info(message)
-            result = self.evaluate(global_eval_step=global_eval_step)
-            checkpoint_name = "{}_epoch{}_step{}_lr{:e}_avg_loss{:.5f}_token_acc{:.5f}_edit_dis{:.5f}.pth".format(
-                self.experiment_name, epoch, global_step, current_lr,
-                loss_meter.avg, result["token_acc"], result["edit_dis"])
-            checkpoint_path = os.path.join(self.args.trainer.save_dir, checkpoint_name)
-            self.save_model(checkpoint_path, epoch=epoch, global_step=global_step, loss=loss_meter.val)
+        # every process takes part in the evaluation, except in the async mode where the master hands it over
+        if global_step > 0 and self.args.trainer.save_step_freq > 0 and global_step % self.args.trainer.save_step_freq == 0 \
+                and (self.args.device.is_master or self.eval_mode != 'async'):
+            self._evaluate_and_save(epoch, global_step, current_lr, loss_meter)
         return global_eval_step
 
     def _print_epoch_log(self, epoch, global_step, global_eval_step, loss_meter, ni, **kwargs):
         current_lr = self._get_current_lr(ni, global_step)
-        if self.args.trainer.save_epoch_freq > 0 and self.args.device.is_master and epoch % self.args.trainer.save_epoch_freq == 0:
-            message = "experiment:{}; eval, (epoch: {}, steps: {});".format(self.experiment_name, epoch, global_step)
-            logger.info(message)
-            result = self.evaluate(global_eval_step=global_eval_step)
-            checkpoint_name = "{}_epoch{}_step{}_lr{:e}_avg_loss{:.5f}_token_acc{:.5f}_edit_dis{:.5f}.pth".format(
-                self.experiment_name, epoch, global_step, current_lr,
-                loss_meter.avg, result["token_acc"], result["edit_dis"])
-            checkpoint_path = os.path.join(self.args.trainer.save_dir, checkpoint_name)
-            self.save_model(checkpoint_path, epoch=epoch, global_step=global_step, loss=loss_meter.val)
+        if self.args.trainer.save_epoch_freq > 0 and epoch % self.args.trainer.save_epoch_freq == 0 \
+                and (self.args.device.is_master or self.eval_mode != 'async'):
+            self._evaluate_and_save(epoch, global_step, current_lr, loss_meter, wait_eval=True)
         return global_eval_step
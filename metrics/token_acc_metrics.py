@@ -1,27 +1,49 @@
 # -*- coding:utf-8 -*-
 # create: @time: 9/20/23 11:52
 import torch
+import torch.distributed as dist
 
 
 class TokenAccMetric:
+    """Token accuracy over the positions where the target or the prediction isn't padding.
+
+    Counts are accumulated as tensors on the device of the sequences, `add` never waits for the device, only `mean`
+    and `per_sample_acc` read the results back. `all_reduce` sums the counts over the processes of torch.distributed.
+    """
+
     def __init__(self, pad_token_id=0, eos_token_id=2, **kwargs):
         self.pad_token_id = pad_token_id
         self.eos_token_id = eos_token_id
-        self.total_tokens = 0
-        self.token_correct = 0
-        self.token_acc = []
+        self.total_tokens = torch.zeros((), dtype=torch.long)
+        self.token_correct = torch.zeros((), dtype=torch.long)
+        self.sample_acc = []
 
     def add(self, tgt_seqs, preds):
-        shape_diff = preds.shape[1] - tgt_seqs.shape[1]
-        if shape_diff < 0:
-            preds = torch.nn.functional.pad(preds, (0, -shape_diff), "constant", self.pad_token_id)
-        elif shape_diff > 0:
-            tgt_seqs = torch.nn.functional.pad(tgt_seqs, (0, shape_diff), "constant", self.pad_token_id)
-        mask = torch.logical_or(tgt_seqs != self.pad_token_id, preds != self.pad_token_id)
-        tok_acc = (preds == tgt_seqs)[mask].float()
-        self.token_acc.append(tok_acc.mean().item())
-        self.token_correct += int(tok_acc.sum().item())
-        self.total_tokens += len(tok_acc)
+        preds = preds.to(tgt_seqs.device, non_blocking=True)
+        length = min(tgt_seqs.shape[1], preds.shape[1])
+        # past the shorter sequence the other side counts as padding: its tokens are all wrong
+        tail = tgt_seqs[:, length:] if tgt_seqs.shape[1] > length else preds[:, length:]
+        tgt_seqs, preds = tgt_seqs[:, :length], preds[:, :length]
+        mask = (tgt_seqs != self.pad_token_id) | (preds != self.pad_token_id)
+        correct = ((preds == tgt_seqs) & mask).sum(1)
+        total = mask.sum(1) + (tail != self.pad_token_id).sum(1)
+        self.sample_acc.append(correct / total.clamp(min=1))
+        self.token_correct = self.token_correct.to(correct.device) + correct.sum()
+        self.total_tokens = self.total_tokens.to(total.device) + total.sum()
+
+    def all_reduce(self, device=None):
+        """Sum the counts of every process, `device` is where they are reduced (a CUDA device for NCCL)."""
+        if not dist.is_available() or not dist.is_initialized() or dist.get_world_size() == 1:
+            return
+        counts = torch.stack([self.token_correct, self.total_tokens]).to(device or self.token_correct.device)
+        dist.all_reduce(counts)
+        self.token_correct, self.total_tokens = counts.unbind()
+
+    def per_sample_acc(self):
+        """Accuracy of every sample added on this process, in order."""
+        if not self.sample_acc:
+            return torch.zeros(0)
+        return torch.cat(self.sample_acc).cpu()
 
     def mean(self):
-        return self.token_correct / self.total_tokens
+        return (self.token_correct.double() / self.total_tokens).item()
@@ -1,7 +1,10 @@
 # -*- coding:utf-8 -*-
 # create: 2021/6/8
 from mydatasets.base_datasets import BaseDataset, BaseImgDataset
-from .donut_dataset import NougatDataset, NougatPadFixSizeCollectFn
+from .donut_dataset import NougatDataset, NougatPadFixSizeCollectFn, normalize_pixel_values
+from .packed_dataset import PackedNougatDataset, pack_nougat_dataset
+from .samplers import ResumableBatchSampler, SeededBatchSampler, ShardSampler, TokenBudgetBatchSampler
+from .batch_augmentation import NougatBatchAugmentation
 
 def get_dataset(dataset_args):
     dataset_type = dataset_args.get("type")
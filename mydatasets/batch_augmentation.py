@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/26
+import math
+
+import torch
+import torch.nn.functional as F
+from torchvision.io import decode_jpeg, encode_jpeg
+
+
+class NougatBatchAugmentation(object):
+    """The training augmentation of NougatDataset applied to a collated batch with torch.
+
+    Mirrors `nougut_train_transform` and the bitmask conversion of `NougatDataset`, with the same probabilities:
+    bitmask, RGB shift, shift-scale-rotate followed by grid distortion, brightness/contrast, JPEG compression and
+    Gaussian noise. It takes the uint8 (batch, 3, height, width) pixel values of `NougatPadFixSizeCollectFn` with
+    `image_boxes`, and only changes the image inside each box, the padding stays as it is. It runs on the tensors'
+    device, the training device after collation or the CPU in DataLoader workers.
+
+    Unlike albumentations it works on the resized image, so noise and JPEG artifacts are at the model's resolution,
+    and the random numbers come from torch.
+    """
+
+    def __init__(self, bitmask_p=.04,
+                 rgb_shift_limit=15, rgb_shift_p=.15,
+                 geometric_p=.15, shift_limit=.01, scale_limit=(-.15, 0), rotate_limit=1,
+                 grid_distortion_p=.5, grid_num_steps=5, distort_limit=.1,
+                 brightness_limit=.1, contrast_limit=(-.2, 0), brightness_contrast_p=.2,
+                 jpeg_quality=95, jpeg_p=.15,
+                 noise_var_limit=(0, 2), noise_p=.2,
+                 **kwargs):
+        self.bitmask_p = bitmask_p
+        self.rgb_shift_limit = rgb_shift_limit
+        self.rgb_shift_p = rgb_shift_p
+        self.geometric_p = geometric_p
+        self.shift_limit = shift_limit
+        self.scale_limit = scale_limit
+        self.rotate_limit = rotate_limit
+        self.grid_distortion_p = grid_distortion_p
+        self.grid_num_steps = grid_num_steps
+        self.distort_limit = distort_limit
+        self.brightness_limit = brightness_limit
+        self.contrast_limit = contrast_limit
+        self.brightness_contrast_p = brightness_contrast_p
+        self.jpeg_quality = jpeg_quality
+        self.jpeg_p = jpeg_p
+        self.noise_var_limit = noise_var_limit
+        self.noise_p = noise_p
+
+    @staticmethod
+    def _uniform(low, high, shape, device):
+        return torch.rand(shape, device=device) * (high - low) + low
+
+    @staticmethod
+    def _box_mask(boxes, height, width):
+        top, left, box_h, box_w = [v.view(-1, 1, 1, 1) for v in boxes.unbind(1)]
+        rows = torch.arange(height, device=boxes.device).view(1, 1, -1, 1)
+        cols = torch.arange(width, device=boxes.device).view(1, 1, 1, -1)
+        return (rows >= top) & (rows < top + box_h) & (cols >= left) & (cols < left + box_w)
+
+    def __call__(self, pixel_values, image_boxes):
+        """Augment uint8 pixel values, `image_boxes` holds the (top, left, height, width) of every image."""
+        height, width = pixel_values.shape[-2:]
+        image_boxes = image_boxes.to(pixel_values.device)
+        mask = self._box_mask(image_boxes, height, width)
+        x = pixel_values.float()
+        # sometimes convert to bitmask
+        self._apply(x, mask, image_boxes, self.bitmask_p, lambda v, boxes, m: torch.where(v != 255, 0., v))
+        self._apply(x, mask, image_boxes, self.rgb_shift_p, self._rgb_shift)
+        self._apply(x, mask, image_boxes, self.geometric_p, self._geometric)
+        self._apply(x, mask, image_boxes, self.brightness_contrast_p, self._brightness_contrast)
+        self._apply(x, mask, image_boxes, self.jpeg_p, self._jpeg)
+        self._apply(x, mask, image_boxes, self.noise_p, self._noise)
+        return x.round_().to(torch.uint8)
+
+    @staticmethod
+    def _apply(x, mask, image_boxes, p, transform):
+        # run a transform on the samples drawn with probability p, inside their image box
+        index = (torch.rand(x.shape[0], device=x.device) < p).nonzero().flatten()
+        if len(index) > 0:
+            values, masks = x[index], mask[index]
+            x[index] = torch.where(masks, transform(values, image_boxes[index], masks), values)
+
+    def _rgb_shift(self, x, boxes, mask):
+        shift = self._uniform(-self.rgb_shift_limit, self.rgb_shift_limit, (x.shape[0], 3, 1, 1), x.device)
+        return (x + shift).clamp_(0, 255)
+
+    def _brightness_contrast(self, x, boxes, mask):
+        alpha = 1 + self._uniform(*self.contrast_limit, (x.shape[0], 1, 1, 1), x.device)
+        beta = self._uniform(-self.brightness_limit, self.brightness_limit, (x.shape[0], 1, 1, 1), x.device) * 255
+        return (x * alpha + beta).clamp_(0, 255)
+
+    def _jpeg(self, x, boxes, mask):
+        x = x.round()
+        for i, (top, left, box_h, box_w) in enumerate(boxes.tolist()):
+            image = x[i, :, top:top + box_h, left:left + box_w].to(device='cpu', dtype=torch.uint8)
+            image = decode_jpeg(encode_jpeg(image.contiguous(), quality=self.jpeg_quality))
+            x[i, :, top:top + box_h, left:left + box_w] = image.to(device=x.device, dtype=x.dtype)
+        return x
+
+    def _noise(self, x, boxes, mask):
+        sigma = self._uniform(*self.noise_var_limit, (x.shape[0], 1, 1, 1), x.device).sqrt_()
+        return (x + torch.randn_like(x) * sigma).clamp_(0, 255)
+
+    def _distort(self, u, num_samples, device):
+        # separable grid distortion: the cells of a regular grid get random widths, as in albumentations
+        steps = 1 + self._uniform(-self.distort_limit, self.distort_limit, (num_samples, self.grid_num_steps),
+                                  device)
+        selected = (torch.rand(num_samples, 1, device=device) < self.grid_distortion_p)
+        steps = torch.where(selected, steps, torch.ones_like(steps))
+        knots = F.pad(steps.cumsum(1), (1, 0))
+        knots = knots / knots[:, -1:]
+        position = u.clamp(0, 1) * self.grid_num_steps
+        cell = position.floor().clamp(max=self.grid_num_steps - 1)
+        start = knots.gather(1, cell.long())
+        end = knots.gather(1, cell.long() + 1)
+        return start + (position - cell) * (end - start)
+
+    def _geometric(self, x, boxes, mask):
+        num_samples, _, height, width = x.shape
+        device = x.device
+        top, left, box_h, box_w = [v.float().view(-1, 1) for v in boxes.unbind(1)]
+        # output pixel centers relative to the box, in [0, 1], through the grid distortion
+        u = self._distort((torch.arange(width, device=device).view(1, -1) + .5 - left) / box_w, num_samples,
+                          device)
+        v = self._distort((torch.arange(height, device=device).view(1, -1) + .5 - top) / box_h, num_samples,
+                          device)
+        # then the inverse of the shift-scale-rotate around the box center
+        angle = self._uniform(-self.rotate_limit, self.rotate_limit, (num_samples, 1, 1), device) * math.pi / 180
+        scale = 1 + self._uniform(*self.scale_limit, (num_samples, 1, 1), device)
+        dx = self._uniform(-self.shift_limit, self.shift_limit, (num_samples, 1, 1), device) * box_w.view(-1, 1, 1)
+        dy = self._uniform(-self.shift_limit, self.shift_limit, (num_samples, 1, 1), device) * box_h.view(-1, 1, 1)
+        px = ((u - .5) * box_w).view(num_samples, 1, width) - dx
+        py = ((v - .5) * box_h).view(num_samples, height, 1) - dy
+        sx = (torch.cos(angle) * px + torch.sin(angle) * py) / scale
+        sy = (-torch.sin(angle) * px + torch.cos(angle) * py) / scale
+        # back to canvas coordinates, sources outside the image are filled with white like border_mode=0
+        sx = sx + (left + box_w / 2).view(-1, 1, 1)
+        sy = sy + (top + box_h / 2).view(-1, 1, 1)
+        left, top = left.view(-1, 1, 1), top.view(-1, 1, 1)
+        right, bottom = left + box_w.view(-1, 1, 1), top + box_h.view(-1, 1, 1)
+        inside = ((sx >= left) & (sx < right) & (sy >= top) & (sy < bottom)).unsqueeze(1)
+        # clamped so that bilinear sampling never mixes in the padding
+        sx = torch.minimum(torch.maximum(sx, left + .5), right - .5)
+        sy = torch.minimum(torch.maximum(sy, top + .5), bottom - .5)
+        grid = torch.stack([sx / width * 2 - 1, sy / height * 2 - 1], dim=-1)
+        out = F.grid_sample(x, grid, mode='bilinear', padding_mode='border', align_corners=False)
+        return torch.where(inside, out, 255.)
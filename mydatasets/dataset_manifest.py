@@ -0,0 +1,100 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/23
+import glob
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+
+import imagesize
+import numpy as np
+from base.driver import logger
+from nougat_latex.util import process_raw_latex_code
+
+MANIFEST_VERSION = 1
+MANIFEST_FIELDS = ('path', 'width', 'height', 'equation_index', 'token_length')
+
+
+def _sources_state(data_root, equations):
+    # a directory's mtime changes when images are added, removed or renamed in it
+    equations_stat = os.stat(equations)
+    return {
+        'data_root': [os.path.abspath(images) for images in data_root],
+        'data_root_mtime': [os.stat(images).st_mtime_ns for images in data_root],
+        'equations': os.path.abspath(equations),
+        'equations_mtime': equations_stat.st_mtime_ns,
+        'equations_size': equations_stat.st_size,
+    }
+
+
+def get_manifest_path(cache_dir, data_root, equations, tokenizer):
+    key = json.dumps([[os.path.abspath(images) for images in data_root], os.path.abspath(equations),
+                      getattr(tokenizer, 'name_or_path', ''), len(tokenizer)])
+    return join(cache_dir, "manifest_{}.npz".format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+
+def build_manifest(data_root, equations, tokenizer, num_workers=16, tokenize_batch_size=4096):
+    """Index every *.png under `data_root`: image size, line of its equation in `equations` and token length."""
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        all_images = [path for paths in executor.map(lambda images: glob.glob(join(images, '*.png')), data_root)
+                      for path in paths]
+        sizes = list(executor.map(imagesize.get, all_images))
+    eqs = open(equations, 'r').read().split('\n')
+    indices = [int(os.path.basename(img).split('.')[0]) for img in all_images]
+    # images without a line in `equations` get a token length of -1
+    token_lengths = np.full(len(indices), -1, dtype=np.int64)
+    has_equation = [i for i, index in enumerate(indices) if index < len(eqs)]
+    for start in range(0, len(has_equation), tokenize_batch_size):
+        batch = has_equation[start:start + tokenize_batch_size]
+        input_ids = tokenizer([process_raw_latex_code(eqs[indices[i]]) for i in batch],
+                              return_token_type_ids=False, return_attention_mask=False).input_ids
+        token_lengths[batch] = [len(ids) for ids in input_ids]
+    return {
+        'path': np.array(all_images, dtype=str),
+        'width': np.array([size[0] for size in sizes], dtype=np.int64),
+        'height': np.array([size[1] for size in sizes], dtype=np.int64),
+        'equation_index': np.array(indices, dtype=np.int64),
+        'token_length': token_lengths,
+    }
+
+
+def load_manifest(manifest_path, data_root, equations):
+    """Return the manifest saved at `manifest_path`, or None when it is missing or its sources changed."""
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with np.load(manifest_path) as data:
+            meta = json.loads(str(data['meta']))
+            if meta.get('version') != MANIFEST_VERSION or meta.get('sources') != _sources_state(data_root,
+                                                                                              equations):
+                return None
+            return {name: data[name] for name in MANIFEST_FIELDS}
+    except (OSError, ValueError, KeyError) as e:
+        logger.warning("failed to read dataset manifest {}: {}".format(manifest_path, e))
+        return None
+
+
+def save_manifest(manifest_path, manifest, data_root, equations):
+    meta = {'version': MANIFEST_VERSION, 'sources': _sources_state(data_root, equations)}
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    # write then rename, ranks starting together never read a partial file
+    tmp_path = "{}.{}.tmp".format(manifest_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, meta=np.array(json.dumps(meta)), **manifest)
+    os.replace(tmp_path, manifest_path)
+
+
+def load_or_build_manifest(data_root, equations, tokenizer, cache_dir=None, num_workers=16):
+    """Dataset manifest of `data_root`, cached under `cache_dir` and rebuilt when the images or equations change."""
+    if cache_dir is None:
+        return build_manifest(data_root, equations, tokenizer, num_workers=num_workers)
+    manifest_path = get_manifest_path(cache_dir, data_root, equations, tokenizer)
+    manifest = load_manifest(manifest_path, data_root, equations)
+    if manifest is not None:
+        logger.info("load dataset manifest {}: {} images".format(manifest_path, len(manifest['path'])))
+        return manifest
+    manifest = build_manifest(data_root, equations, tokenizer, num_workers=num_workers)
+    save_manifest(manifest_path, manifest, data_root, equations)
+    logger.info("build dataset manifest {}: {} images".format(manifest_path, len(manifest['path'])))
+    return manifest
@@ -1,22 +1,18 @@
 # -*- coding:utf-8 -*-
 # create: @time: 6/6/23 10:30
-import glob
 import os
 import os.path
-import random
-from os.path import join
 
 import albumentations as alb
 import cv2
-import imagesize
 import numpy as np
 import torch
 from PIL import Image, ImageFile
-from base.driver import CACHE_ROOT
+from base.driver import CACHE_ROOT, logger
+from mydatasets.dataset_manifest import load_or_build_manifest
 from nougat_latex.util import process_raw_latex_code
 from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data import Dataset
-from torchvision.transforms.functional import to_pil_image
 from tqdm import tqdm
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -48,26 +44,47 @@ class NougatDataset(Dataset):
             max_length: int,
             phase: str = "train",
             max_dimensions=(1024, 512), min_dimensions=(32, 32),
+            cache_dir=None,
+            manifest_workers=16,
+            max_load_attempts=3,
+            augment=True,
             **kwargs
     ):
         super().__init__()
         self.processor = processor
         self.max_length = max_length
         self.phase = phase
-        self.images = []
+        self.max_load_attempts = max_load_attempts
 
-        all_images = [path for images in data_root for path in glob.glob(join(images, '*.png'))]
-        for img in all_images:
-            width, height = imagesize.get(img)
-            if min_dimensions[0] <= width <= max_dimensions[0] and min_dimensions[1] <= height <= max_dimensions[1]:
-                self.images.append(img)
+        # image sizes, equation lines and token lengths, cached under cache_dir between runs
+        manifest = load_or_build_manifest(data_root, equations, processor.tokenizer, cache_dir=cache_dir,
+                                          num_workers=manifest_workers)
+        width, height, token_lengths = manifest['width'], manifest['height'], manifest['token_length']
+        # drop invalid samples up front, each one counted under the first check it fails
+        readable = (width > 0) & (height > 0)
+        in_dimensions = (min_dimensions[0] <= width) & (width <= max_dimensions[0]) & \
+                        (min_dimensions[1] <= height) & (height <= max_dimensions[1])
+        has_equation = token_lengths >= 0
+        short_enough = token_lengths <= max_length
+        keep = readable & in_dimensions & has_equation & short_enough
+        self.num_dropped = {
+            'unreadable': int((~readable).sum()),
+            'dimensions': int((readable & ~in_dimensions).sum()),
+            'missing_equation': int((readable & in_dimensions & ~has_equation).sum()),
+            'too_long': int((readable & in_dimensions & has_equation & ~short_enough).sum()),
+        }
+        logger.info("dataset {}: {} samples, dropped {}".format(data_root, int(keep.sum()), self.num_dropped))
+        self.images = manifest['path'][keep].tolist()
+        self.indices = manifest['equation_index'][keep].tolist()
+        self.token_lengths = manifest['token_length'][keep]
         eqs = open(equations, 'r').read().split('\n')
-        self.indices = [int(os.path.basename(img).split('.')[0]) for img in self.images]
 
         self.pairs = list()
         for i, im in tqdm(enumerate(self.images), total=len(self.images)):
             self.pairs.append((eqs[self.indices[i]], im))
-        if phase == "train":
+        # augment=False leaves the training augmentation to NougatBatchAugmentation
+        self.augment = phase == "train" and augment
+        if self.augment:
             self.transforms = nougut_train_transform
         else:
             self.transforms = None
@@ -76,58 +93,97 @@ class NougatDataset(Dataset):
         return len(self.pairs)
 
     def __getitem__(self, idx: int):
-        batch = self.pairs[idx]
-        eqs, img_path = batch
+        # overlong equations are already filtered out, only an image that fails to decode moves on to the
+        # next samples, a bounded number of times
+        for attempt in range(self.max_load_attempts):
+            eqs, img_path = self.pairs[(idx + attempt) % len(self.pairs)]
+            im = cv2.imread(img_path)
+            if im is not None:
+                break
+            logger.warning("failed to load image {}".format(img_path))
+        else:
+            raise IOError("failed to load {} images from index {}".format(self.max_load_attempts, idx))
         eqs = process_raw_latex_code(eqs)  # remove unnecessary blank in the latex codes
-        im = cv2.imread(img_path)
         tok = self.processor.tokenizer(eqs, return_token_type_ids=False)
-        # check if sequence length is too long
-        if self.max_length < len(tok.attention_mask) or im is None:
-            random_index = random.randrange(self.__len__())
-            return self.__getitem__(random_index)
+        im = self._augment_image(im)
+        return tok, im, eqs
+
+    def _augment_image(self, im):
         # augmentation
         im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-        if self.phase == "train":
+        if self.augment:
             # sometimes convert to bitmask
             if np.random.random() < .04:
                 im[im != 255] = 0
         if self.transforms is not None:
             im = self.transforms(image=im)['image']
-        return tok, im, eqs
+        return im
+
+
+def normalize_pixel_values(pixel_values, image_processor, dtype=torch.float32):
+    """Rescale and normalize a uint8 (batch, 3, height, width) tensor like the image processor, on its device.
+
+    Matches the processor's output up to float32 rounding.
+    """
+    pixel_values = pixel_values.to(dtype=dtype)
+    if image_processor.do_rescale:
+        pixel_values = pixel_values.mul_(image_processor.rescale_factor)
+    if image_processor.do_normalize:
+        mean = torch.tensor(image_processor.image_mean, dtype=dtype, device=pixel_values.device).view(1, -1, 1, 1)
+        std = torch.tensor(image_processor.image_std, dtype=dtype, device=pixel_values.device).view(1, -1, 1, 1)
+        pixel_values = pixel_values.sub_(mean).div_(std)
+    return pixel_values
 
 
 class NougatPadFixSizeCollectFn(object):
-    def __init__(self, batch_size, processor, debug=False, maxH=None, **kwargs):
+    def __init__(self, batch_size, processor, debug=False, maxH=None, uint8_pixel_values=False, augmentation=None,
+                 **kwargs):
         self.debug = debug
         self.batch_size = batch_size
         self.pad_token_id = processor.tokenizer.pad_token_id
         self.processor = processor
+        self.image_processor = processor.image_processor
         self.imgW = processor.image_processor.size['width']
         self.imgH = processor.image_processor.size['height']
         self.maxH = self.imgH // 2 if maxH is None else maxH
+        # leave rescaling and normalization to normalize_pixel_values on the training device
+        self.uint8_pixel_values = uint8_pixel_values
+        # NougatBatchAugmentation run on the uint8 batch, in the DataLoader workers
+        self.augmentation = augmentation
+        # the padded canvas of a short image already has the processor's output size, it only goes through the
+        # processor's fitting steps again when these can change it
+        self.refit_canvas = self.image_processor.do_crop_margin or self.image_processor.do_align_long_axis
+
+    def _place_image(self, pixel_values, img):
+        # write a PIL image into a uint8 (3, imgH, imgW) slot, centered like the processor's padding
+        width, height = img.size
+        top = (self.imgH - height) // 2
+        left = (self.imgW - width) // 2
+        pixel_values[:, top:top + height, left:left + width] = np.asarray(img).transpose(2, 0, 1)
+        return top, left, height, width
 
     def __call__(self, instances):
         batch = dict(labels=list(), mask=list(), processed_parse=list())
-        img_batch = []
         for instance in instances:
             # labels
             batch['labels'].append(instance[0].input_ids[1:])
             # attention mask
             batch['mask'].append(instance[0].attention_mask[1:])
             batch['processed_parse'].append(instance[2])
-            img_batch.append(to_pil_image(instance[1]))
         # input_ids
         batch['labels'] = pad_sequence([torch.LongTensor(x) for x in batch['labels']], batch_first=True,
                                        padding_value=self.pad_token_id)
         # attention_mask
         batch['mask'] = pad_sequence([torch.LongTensor(x) for x in batch['mask']], batch_first=True,
                                      padding_value=0)
-        pixel_values = []
-        # pixel_values
+        # pixel_values, every image written once into a preallocated uint8 batch
+        pixel_values = np.zeros((len(instances), 3, self.imgH, self.imgW), dtype=np.uint8)
+        # (top, left, height, width) of every image in its canvas
+        image_boxes = np.zeros((len(instances), 4), dtype=np.int64)
         max_w = self.imgW
-        for i, img in enumerate(img_batch):
+        for i, instance in enumerate(instances):
+            img = Image.fromarray(instance[1])
             if img.height < self.maxH:
-                empty_img = Image.new("RGB", (self.imgW, self.imgH))
                 target_w = max(1, int(img.width / img.height * self.maxH))
                 if target_w > max_w:
                     target_w = max_w
@@ -135,13 +191,35 @@ class NougatPadFixSizeCollectFn(object):
                 else:
                     target_h = self.maxH
                 img = img.resize((target_w, target_h))
+                # pasted at the left of a black canvas, vertically centered
                 start_h = (self.imgH - target_h) // 2
-                start_w = 0
-                empty_img.paste(img, (start_w, start_h))
-                img = empty_img
-            pixel_values.append(self.processor(img, return_tensors="pt").pixel_values)
+                pixel_values[i, :, start_h:start_h + target_h, :target_w] = np.asarray(img).transpose(2, 0, 1)
+                image_boxes[i] = start_h, 0, target_h, target_w
+                if self.refit_canvas:
+                    img = self.image_processor.fit_image(Image.fromarray(pixel_values[i].transpose(1, 2, 0)))
+                    pixel_values[i] = 0
+                    image_boxes[i] = self._place_image(pixel_values[i], img)
+            else:
+                image_boxes[i] = self._place_image(pixel_values[i], self.image_processor.fit_image(img))
             if self.debug:
                 cache_path = os.path.join(CACHE_ROOT, "{}.jpg".format(i))
-                img.save(cache_path)
-        batch['pixel_values'] = torch.cat(pixel_values)
+                Image.fromarray(pixel_values[i].transpose(1, 2, 0)).save(cache_path)
+        if self.augmentation is not None:
+            pixel_values = self.augmentation(torch.from_numpy(pixel_values), torch.from_numpy(image_boxes)).numpy()
+        if not self.uint8_pixel_values:
+            pixel_values = self._normalize(pixel_values)
+        batch['pixel_values'] = torch.from_numpy(pixel_values)
+        batch['image_boxes'] = torch.from_numpy(image_boxes)
         return batch
+
+    def _normalize(self, pixel_values):
+        # same arithmetic as the processor's rescale and normalize, over the whole batch
+        normalized = np.empty(pixel_values.shape, dtype=np.float32)
+        if self.image_processor.do_rescale:
+            np.multiply(pixel_values, self.image_processor.rescale_factor, out=normalized)
+        else:
+            normalized[...] = pixel_values
+        if self.image_processor.do_normalize:
+            normalized -= np.array(self.image_processor.image_mean, dtype=np.float32).reshape(-1, 1, 1)
+            normalized /= np.array(self.image_processor.image_std, dtype=np.float32).reshape(-1, 1, 1)
+        return normalized
@@ -0,0 +1,210 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/22
+import glob
+import json
+import os
+from os.path import join
+
+import cv2
+import imagesize
+import numpy as np
+from base.driver import logger
+from nougat_latex.util import process_raw_latex_code
+from torch.utils.data import Dataset
+from tqdm import tqdm
+from transformers import BatchEncoding
+
+from .donut_dataset import NougatDataset, nougut_train_transform
+
+PACK_VERSION = 2
+# one record per sample, offsets point into the shard / token / equation files
+INDEX_DTYPE = np.dtype([
+    ('shard', '<u4'),
+    ('image_offset', '<u8'),
+    ('image_length', '<u4'),
+    ('token_offset', '<u8'),
+    ('token_length', '<u4'),
+    ('equation_offset', '<u8'),
+    ('equation_length', '<u4'),
+    ('width', '<u4'),
+    ('height', '<u4'),
+])
+META_FILE = 'meta.json'
+INDEX_FILE = 'index.npy'
+TOKENS_FILE = 'tokens.npy'
+EQUATIONS_FILE = 'equations.bin'
+SHARD_FILE = 'images-{:05d}.bin'
+
+
+def pack_nougat_dataset(data_root, equations, tokenizer, output_dir, shard_bytes=1 << 30,
+                        max_dimensions=(1024, 512), min_dimensions=(32, 32)):
+    """Write the samples of a NougatDataset into packed files read by PackedNougatDataset.
+
+    Equations are normalized with `process_raw_latex_code` and tokenized once, images are stored as their encoded
+    file bytes in shards of about `shard_bytes`. Images that can't be decoded or have no line in `equations` are left
+    out.
+    """
+    if not isinstance(data_root, (list, tuple)):
+        data_root = [data_root]
+    os.makedirs(output_dir, exist_ok=True)
+    all_images = [path for images in data_root for path in glob.glob(join(images, '*.png'))]
+    eqs = open(equations, 'r').read().split('\n')
+
+    records, tokens = [], []
+    token_offset = equation_offset = 0
+    shard, shard_offset, shard_file = 0, 0, None
+    num_invalid = num_missing_equation = 0
+    with open(join(output_dir, EQUATIONS_FILE), 'wb') as equation_file:
+        for img in tqdm(all_images, total=len(all_images)):
+            width, height = imagesize.get(img)
+            if not (min_dimensions[0] <= width <= max_dimensions[0] and
+                    min_dimensions[1] <= height <= max_dimensions[1]):
+                continue
+            with open(img, 'rb') as f:
+                image_bytes = f.read()
+            if cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR) is None:
+                num_invalid += 1
+                continue
+            eq_index = int(os.path.basename(img).split('.')[0])
+            if eq_index >= len(eqs):
+                num_missing_equation += 1
+                continue
+            if shard_file is None or (shard_offset > 0 and shard_offset + len(image_bytes) > shard_bytes):
+                if shard_file is not None:
+                    shard_file.close()
+                    shard += 1
+                shard_file = open(join(output_dir, SHARD_FILE.format(shard)), 'wb')
+                shard_offset = 0
+            shard_file.write(image_bytes)
+
+            equation = process_raw_latex_code(eqs[eq_index])
+            input_ids = tokenizer(equation, return_token_type_ids=False).input_ids
+            equation_bytes = equation.encode('utf-8')
+            equation_file.write(equation_bytes)
+            tokens.append(np.asarray(input_ids, dtype=np.int32))
+            records.append((shard, shard_offset, len(image_bytes), token_offset, len(input_ids),
+                            equation_offset, len(equation_bytes), width, height))
+            shard_offset += len(image_bytes)
+            token_offset += len(input_ids)
+            equation_offset += len(equation_bytes)
+    if shard_file is not None:
+        shard_file.close()
+
+    np.save(join(output_dir, INDEX_FILE), np.array(records, dtype=INDEX_DTYPE))
+    np.save(join(output_dir, TOKENS_FILE), np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.int32))
+    meta = {
+        'version': PACK_VERSION,
+        'num_samples': len(records),
+        'num_shards': shard + 1 if shard_file is not None else 0,
+        'num_invalid_images': num_invalid,
+        'num_missing_equations': num_missing_equation,
+        'tokenizer': getattr(tokenizer, 'name_or_path', ''),
+        'tokenizer_size': len(tokenizer),
+        'data_root': list(data_root),
+        'equations': equations,
+    }
+    with open(join(output_dir, META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    logger.info("packed {} samples into {} shards under {}, skipped {} invalid images and {} without equation".format(
+        meta['num_samples'], meta['num_shards'], output_dir, num_invalid, num_missing_equation))
+    return meta
+
+
+class PackedNougatDataset(NougatDataset):
+    """NougatDataset reading the output of `pack_nougat_dataset` through memory maps.
+
+    Equations come normalized and tokenized, so `__getitem__` only decodes the image and augments it. Like
+    NougatDataset, samples with more than `max_length` tokens are dropped when the dataset is created and counted in
+    `num_dropped`.
+    """
+
+    def __init__(
+            self,
+            data_root,
+            processor,
+            max_length: int,
+            phase: str = "train",
+            max_dimensions=(1024, 512), min_dimensions=(32, 32),
+            augment=True,
+            **kwargs
+    ):
+        Dataset.__init__(self)
+        self.processor = processor
+        self.max_length = max_length
+        self.phase = phase
+        self.pack_dirs = data_root if isinstance(data_root, (list, tuple)) else [data_root]
+        self.index = []
+        self.num_dropped = {'unreadable': 0, 'dimensions': 0, 'missing_equation': 0, 'too_long': 0}
+        tokenizer = processor.tokenizer
+        items = []
+        for pack_id, pack_dir in enumerate(self.pack_dirs):
+            with open(join(pack_dir, META_FILE), 'r') as f:
+                meta = json.load(f)
+            if meta['version'] != PACK_VERSION:
+                raise ValueError("{} was packed with version {}, expected {}".format(
+                    pack_dir, meta['version'], PACK_VERSION))
+            # the token ids were computed when packing, with the tokenizer of the pack
+            if meta['tokenizer'] != tokenizer.name_or_path or meta['tokenizer_size'] != len(tokenizer):
+                raise ValueError("{} was packed with tokenizer {} ({} tokens), expected {} ({} tokens)".format(
+                    pack_dir, meta['tokenizer'], meta['tokenizer_size'], tokenizer.name_or_path, len(tokenizer)))
+            index = np.load(join(pack_dir, INDEX_FILE))
+            self.index.append(index)
+            in_dimensions = ((min_dimensions[0] <= index['width']) & (index['width'] <= max_dimensions[0]) &
+                             (min_dimensions[1] <= index['height']) & (index['height'] <= max_dimensions[1]))
+            short_enough = index['token_length'] <= max_length
+            keep = in_dimensions & short_enough
+            # images that failed to decode or had no equation were already left out by pack_nougat_dataset
+            self.num_dropped['unreadable'] += meta['num_invalid_images']
+            self.num_dropped['missing_equation'] += meta['num_missing_equations']
+            self.num_dropped['dimensions'] += int((~in_dimensions).sum())
+            self.num_dropped['too_long'] += int((in_dimensions & ~short_enough).sum())
+            items.extend((pack_id, i) for i in np.flatnonzero(keep).tolist())
+        self.items = items
+        self.token_lengths = np.array([self.index[pack_id][i]['token_length'] for pack_id, i in items],
+                                      dtype=np.int64)
+        # files are mapped lazily, in the DataLoader worker that reads them
+        self._maps = {}
+        logger.info("packed dataset {}: {} samples, dropped {}".format(self.pack_dirs, len(self.items),
+                                                                       self.num_dropped))
+        # augment=False leaves the training augmentation to NougatBatchAugmentation
+        self.augment = phase == "train" and augment
+        if self.augment:
+            self.transforms = nougut_train_transform
+        else:
+            self.transforms = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getstate__(self):
+        # memory maps would be pickled with their whole content, workers map the files again
+        state = self.__dict__.copy()
+        state['_maps'] = {}
+        return state
+
+    def _read(self, pack_id, file_name, offset, length):
+        if length == 0:
+            # np.memmap can't map an empty file
+            return np.zeros(0, dtype=np.uint8)
+        key = (pack_id, file_name)
+        if key not in self._maps:
+            path = join(self.pack_dirs[pack_id], file_name)
+            if file_name == TOKENS_FILE:
+                self._maps[key] = np.load(path, mmap_mode='r')
+            else:
+                self._maps[key] = np.memmap(path, dtype=np.uint8, mode='r')
+        return self._maps[key][offset:offset + length]
+
+    def __getitem__(self, idx: int):
+        pack_id, i = self.items[idx]
+        record = self.index[pack_id][i]
+        token_length = int(record['token_length'])
+        input_ids = self._read(pack_id, TOKENS_FILE, int(record['token_offset']), token_length).tolist()
+        tok = BatchEncoding({'input_ids': input_ids, 'attention_mask': [1] * token_length})
+        eqs = self._read(pack_id, EQUATIONS_FILE, int(record['equation_offset']),
+                         int(record['equation_length'])).tobytes().decode('utf-8')
+        image_bytes = self._read(pack_id, SHARD_FILE.format(int(record['shard'])), int(record['image_offset']),
+                                 int(record['image_length']))
+        im = cv2.imdecode(image_bytes, cv2.IMREAD_COLOR)
+        im = self._augment_image(im)
+        return tok, im, eqs
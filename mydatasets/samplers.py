@@ -0,0 +1,147 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/24
+import math
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class ResumableBatchSampler(Sampler):
+    """Base of the batch samplers that shard batches over the ranks themselves and can start in the middle of an epoch.
+
+    The batches of an epoch only depend on `seed` and the epoch, with the same seed on every rank. Each of the
+    `num_replicas` ranks takes every `num_replicas`-th batch, the batch list being padded so that all ranks run the
+    same number of steps. A resumed run gets the batches of the interrupted one back, and `set_start_batch` skips
+    those already trained on without loading them.
+    """
+
+    def __init__(self, shuffle=True, seed=0, num_replicas=1, rank=0, drop_last=False):
+        super().__init__()
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.start_batch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def set_start_batch(self, start_batch):
+        # only applies to the next iteration, the following epochs start from their first batch
+        self.start_batch = start_batch
+
+    def state_dict(self):
+        return {'seed': self.seed, 'epoch': self.epoch}
+
+    def load_state_dict(self, state_dict):
+        self.seed = state_dict['seed']
+        self.epoch = state_dict['epoch']
+
+    def _epoch_batches(self, rng):
+        """All the batches of an epoch, drawn from `rng`."""
+        raise NotImplementedError
+
+    def _num_batches(self):
+        raise NotImplementedError
+
+    def _num_bucket_batches(self, num_samples, batch_size):
+        if self.drop_last:
+            return num_samples // batch_size
+        return math.ceil(num_samples / batch_size)
+
+    def __len__(self):
+        return math.ceil(self._num_batches() / self.num_replicas)
+
+    def __iter__(self):
+        batches = self._epoch_batches(np.random.default_rng(self.seed + self.epoch))
+        # every rank runs len(self) steps, the first batches are repeated to even them out
+        total = len(self) * self.num_replicas
+        while len(batches) < total:
+            batches += batches[:total - len(batches)]
+        start_batch, self.start_batch = self.start_batch, 0
+        return iter(batches[self.rank + start_batch * self.num_replicas:total:self.num_replicas])
+
+
+class SeededBatchSampler(ResumableBatchSampler):
+    """Batches of `batch_size` samples of a seeded permutation of the dataset, the default training batch sampler."""
+
+    def __init__(self, num_samples, batch_size, shuffle=True, seed=0, num_replicas=1, rank=0, drop_last=False,
+                 **kwargs):
+        super().__init__(shuffle=shuffle, seed=seed, num_replicas=num_replicas, rank=rank, drop_last=drop_last)
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+
+    def _num_batches(self):
+        return self._num_bucket_batches(self.num_samples, self.batch_size)
+
+    def _epoch_batches(self, rng):
+        indices = rng.permutation(self.num_samples) if self.shuffle else np.arange(self.num_samples)
+        return [indices[i * self.batch_size:(i + 1) * self.batch_size].tolist() for i in range(self._num_batches())]
+
+
+class TokenBudgetBatchSampler(ResumableBatchSampler):
+    """Batches of similar label length bounded by a token budget instead of a fixed batch size.
+
+    Samples are bucketed by token length in steps of `bucket_width`. Every bucket has its own batch size,
+    `max_tokens` divided by the bucket's longest possible length, so a padded batch never holds more than `max_tokens`
+    tokens, nor more than `max_batch_size` images: the budget only counts decoder tokens while the encoder memory
+    grows with the number of images. Samples are shuffled within their bucket and the batches of all buckets are
+    shuffled together.
+    """
+
+    def __init__(self, lengths, max_tokens, bucket_width=32, max_batch_size=None, shuffle=True, seed=0,
+                 num_replicas=1, rank=0, drop_last=False, **kwargs):
+        super().__init__(shuffle=shuffle, seed=seed, num_replicas=num_replicas, rank=rank, drop_last=drop_last)
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        if len(self.lengths) and self.lengths.max() > max_tokens:
+            raise ValueError("max_tokens {} is smaller than the longest sample ({} tokens)".format(
+                max_tokens, self.lengths.max()))
+        self.max_tokens = max_tokens
+        self.bucket_width = bucket_width
+        self.max_batch_size = max_batch_size
+
+        bucket_ids = (np.maximum(self.lengths, 1) - 1) // bucket_width
+        self.buckets = []
+        for bucket_id in np.unique(bucket_ids):
+            indices = np.flatnonzero(bucket_ids == bucket_id)
+            longest = min((bucket_id + 1) * bucket_width, self.lengths[indices].max())
+            batch_size = max(1, self.max_tokens // int(longest))
+            if self.max_batch_size is not None:
+                batch_size = min(batch_size, self.max_batch_size)
+            self.buckets.append((indices, batch_size))
+
+    def _num_batches(self):
+        return sum(self._num_bucket_batches(len(indices), batch_size) for indices, batch_size in self.buckets)
+
+    def _epoch_batches(self, rng):
+        batches = []
+        for indices, batch_size in self.buckets:
+            if self.shuffle:
+                indices = rng.permutation(indices)
+            num_batches = self._num_bucket_batches(len(indices), batch_size)
+            batches.extend(indices[i * batch_size:(i + 1) * batch_size].tolist() for i in range(num_batches))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+
+class ShardSampler(Sampler):
+    """Every `num_replicas`-th sample from `rank` on, for evaluation on every rank.
+
+    Unlike DistributedSampler the shards are not padded to the same length, so every sample is evaluated exactly once
+    and the metrics summed over the ranks are those of a single process run.
+    """
+
+    def __init__(self, num_samples, num_replicas=1, rank=0):
+        super().__init__()
+        self.num_samples = num_samples
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def __len__(self):
+        return len(range(self.rank, self.num_samples, self.num_replicas))
+
+    def __iter__(self):
+        return iter(range(self.rank, self.num_samples, self.num_replicas))
@@ -141,6 +141,31 @@ class NougatImageProcessor(BaseImageProcessor):
         height = max_values[1] - y_min + 1
         return x_min, y_min, width, height
 
+    def projection_bounding_rect(self, mask: np.array):
+        """Same result as `python_bounding_rect(python_find_non_zero(mask))`, computed from the row and column
+        `any()` projections of the mask so only O(H+W) extra memory is needed."""
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        x_min, y_min = int(cols[0]), int(rows[0])
+        width = int(cols[-1]) - x_min + 1
+        height = int(rows[-1]) - y_min + 1
+        return x_min, y_min, width, height
+
+    def batch_projection_bounding_rect(self, masks: np.array):
+        """Batched `projection_bounding_rect` over a (N, H, W) stack of masks.
+
+        Returns an (N, 4) int array of `(x_min, y_min, width, height)`, rows of empty masks are set to -1.
+        """
+        rows = masks.any(axis=2)
+        cols = masks.any(axis=1)
+        y_min = rows.argmax(axis=1)
+        y_max = rows.shape[1] - 1 - rows[:, ::-1].argmax(axis=1)
+        x_min = cols.argmax(axis=1)
+        x_max = cols.shape[1] - 1 - cols[:, ::-1].argmax(axis=1)
+        rects = np.stack([x_min, y_min, x_max - x_min + 1, y_max - y_min + 1], axis=1).astype(int)
+        rects[~rows.any(axis=1)] = -1
+        return rects
+
     def crop_margin(
         self,
         image: np.array,
@@ -180,8 +205,7 @@ class NougatImageProcessor(BaseImageProcessor):
             return image
         data = (data - min_val) / (max_val - min_val) * 255
         gray = data < gray_threshold
-        coords = self.python_find_non_zero(gray)
-        x_min, y_min, width, height = self.python_bounding_rect(coords)
+        x_min, y_min, width, height = self.projection_bounding_rect(gray)
         image = image.crop((x_min, y_min, x_min + width, y_min + height))
         image = np.array(image).astype(np.uint8)
         image = to_channel_dimension_format(image, input_data_format, ChannelDimension.LAST)
@@ -508,3 +532,100 @@ class NougatImageProcessor(BaseImageProcessor):
 
         data = {"pixel_values": images}
         return BatchFeature(data=data, tensor_type=return_tensors)
+
+    def fit_image(self, image: "PIL.Image.Image") -> "PIL.Image.Image":
+        """Apply the crop / align / resize / thumbnail steps of `preprocess` to a single PIL image."""
+        size = self.size
+        if not isinstance(image, PIL.Image.Image):
+            image = to_pil_image(image)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if self.do_crop_margin:
+            image = PIL.Image.fromarray(self.crop_margin(np.array(image), input_data_format=ChannelDimension.LAST))
+        if self.do_align_long_axis:
+            image = PIL.Image.fromarray(
+                np.ascontiguousarray(
+                    self.align_long_axis(np.array(image), size=size, input_data_format=ChannelDimension.LAST)
+                )
+            )
+        if self.do_resize:
+            # same output size as `get_resize_output_image_size` with the shortest edge of `size`
+            shortest_edge = min(size["height"], size["width"])
+            width, height = image.size
+            short, long = (width, height) if width <= height else (height, width)
+            new_long = int(shortest_edge * long / short)
+            height, width = (new_long, shortest_edge) if width <= height else (shortest_edge, new_long)
+            image = image.resize((width, height), resample=self.resample)
+        if self.do_thumbnail:
+            input_width, input_height = image.size
+            height = min(input_height, size["height"])
+            width = min(input_width, size["width"])
+            if height != input_height or width != input_width:
+                if input_height > input_width:
+                    width = int(input_width * height / input_height)
+                elif input_width > input_height:
+                    height = int(input_height * width / input_width)
+                image = image.resize((width, height), resample=PILImageResampling.BICUBIC, reducing_gap=2.0)
+        return image
+
+    def _rescale_and_normalize(self, images, out):
+        # channels last uint8 `images` into the float32 array `out`
+        if self.do_rescale:
+            np.multiply(images, self.rescale_factor, out=out)
+        else:
+            out[...] = images
+        if self.do_normalize:
+            out -= np.array(self.image_mean, dtype=np.float32)
+            out /= np.array(self.image_std, dtype=np.float32)
+
+    def preprocess_batch(
+        self,
+        images: List["PIL.Image.Image"],
+        dtype: np.dtype = np.float32,
+        return_tensors: Optional[Union[str, TensorType]] = None,
+    ) -> BatchFeature:
+        """
+        Preprocess a list of images into a single `(batch_size, num_channels, height, width)` array.
+
+        Uses the processor settings and gives the same pixel values as `preprocess`, but every image is written
+        once into a preallocated uint8 batch, and padding, rescaling and normalization then run over the whole
+        batch at once. They write straight into the pixel values of the requested `dtype`, through a float32 buffer
+        of one image for other dtypes than float32.
+
+        Args:
+            images (`List[PIL.Image.Image]`):
+                Images to preprocess, with pixel values ranging from 0 to 255.
+            dtype (`np.dtype`, *optional*, defaults to `np.float32`):
+                Data type of the returned pixel values, e.g. `np.float16` to halve the transfer size.
+            return_tensors (`str` or `TensorType`, *optional*):
+                The type of tensors to return, see `preprocess`.
+        """
+        output_height, output_width = self.size["height"], self.size["width"]
+        batch = np.zeros((len(images), output_height, output_width, 3), dtype=np.uint8)
+        for i, image in enumerate(images):
+            image = self.fit_image(image)
+            width, height = image.size
+            if width > output_width or height > output_height or (
+                not self.do_pad and (width, height) != (output_width, output_height)
+            ):
+                raise ValueError(
+                    "preprocess_batch needs every image to fit in size, got {}x{}".format(width, height)
+                )
+            # centered like `pad_image`, the constant 0 padding is already in the buffer
+            top = (output_height - height) // 2
+            left = (output_width - width) // 2
+            batch[i, top : top + height, left : left + width] = np.asarray(image)
+
+        pixel_values = np.empty((len(images), 3, output_height, output_width), dtype=dtype)
+        channels_last = pixel_values.transpose(0, 2, 3, 1)
+        if pixel_values.dtype == np.float32:
+            self._rescale_and_normalize(batch, channels_last)
+        else:
+            # computed in float32 one image at a time, so the values are rounded once into the batch
+            scratch = np.empty(batch.shape[1:], dtype=np.float32)
+            for image, out in zip(batch, channels_last):
+                self._rescale_and_normalize(image, scratch)
+                out[...] = scratch
+
+        data = {"pixel_values": pixel_values}
+        return BatchFeature(data=data, tensor_type=return_tensors)
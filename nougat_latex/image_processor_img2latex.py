@@ -12,19 +12,29 @@ class NougatLaTexProcessor(NougatImageProcessor):
         self.maxH = img_height // 2
         super(NougatLaTexProcessor, self).__init__(**kwargs)
 
-    def __call__(self, images, **kwargs):
+    def __call__(self, images, batched=False, **kwargs):
+        if batched:
+            # a list of images preprocessed together into one pixel_values array
+            return self.preprocess_batch([self._rescale(image) for image in images], **kwargs)
         images = self._rescale(images)
         return self.preprocess(images, **kwargs)
 
+    def get_aspect_ratio(self, images):
+        return images.width / images.height
+
+    def _get_target_size(self, images):
+        target_w = max(1, int(self.get_aspect_ratio(images) * self.maxH))
+        if target_w > self.imgW:
+            target_w = self.imgW
+            target_h = max(1, int(self.imgW / images.width * images.height))
+        else:
+            target_h = self.maxH
+        return target_w, target_h
+
     def _rescale(self, images):
         if images.height < self.maxH:
             empty_img = Image.new("RGB", (self.imgW, self.imgH))
-            target_w = max(1, int(images.width / images.height * self.maxH))
-            if target_w > self.imgW:
-                target_w = self.imgW
-                target_h = max(1, int(self.imgW / images.width * images.height))
-            else:
-                target_h = self.maxH
+            target_w, target_h = self._get_target_size(images)
             images = images.resize((target_w, target_h))
             start_h = (self.imgH - target_h) // 2
             start_w = 0
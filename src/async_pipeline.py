@@ -0,0 +1,198 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from nougat_latex_processor import recognize_batch
+from latex_cache import default_cache
+
+# Passed down a stage queue once its producers are done
+_STOP = object()
+
+
+# A parsed file travelling through the pipeline
+class DocumentJob(object):
+    def __init__(self, file_path, data_list, loop):
+        self.file_path = file_path
+        self.data_list = data_list
+        # image url -> asyncio Future of its list of LaTeX results
+        self.latex = {}
+        for item in data_list:
+            if item["type"] == "image" and item["image_url"] not in self.latex:
+                self.latex[item["image_url"]] = loop.create_future()
+
+    @property
+    def name(self):
+        return os.path.basename(self.file_path)
+
+
+class AsyncPdfPipeline(object):
+    """PDF-to-docx conversion as bounded asyncio stages.
+
+    upload (TextIn) -> download images -> OCR batches -> docx assembly. Stages are linked by
+    bounded queues, so a slow stage holds back the ones feeding it instead of piling up
+    work. Blocking calls run on a dedicated executor per stage, sized by its concurrency.
+    The OCR stage batches images across documents and hands each batch to `recognize`
+    (in-process `recognize_batch` by default, or e.g. an `OcrWorkerPool`).
+    """
+
+    def __init__(
+        self,
+        parse_file,
+        save_document,
+        downloader,
+        output_directory,
+        upload_concurrency=4,
+        download_concurrency=16,
+        ocr_batch_size=8,
+        assemble_concurrency=2,
+        queue_size=8,
+        recognize=None,
+        ocr_concurrency=1,
+    ):
+        self.parse_file = parse_file
+        self.save_document = save_document
+        self.downloader = downloader
+        self.output_directory = output_directory
+        self.upload_concurrency = upload_concurrency
+        self.download_concurrency = download_concurrency
+        self.ocr_batch_size = ocr_batch_size
+        self.assemble_concurrency = assemble_concurrency
+        self.queue_size = queue_size
+        self.recognize = recognize or functools.partial(recognize_batch, cache=default_cache)
+        self.ocr_concurrency = ocr_concurrency
+
+    async def run(self, file_paths):
+        loop = asyncio.get_running_loop()
+        upload_queue = asyncio.Queue()
+        for file_path in file_paths:
+            upload_queue.put_nowait(file_path)
+        download_queue = asyncio.Queue(maxsize=self.queue_size)
+        ocr_queue = asyncio.Queue(maxsize=self.ocr_batch_size * (self.ocr_concurrency + 1))
+        assemble_queue = asyncio.Queue(maxsize=self.queue_size)
+
+        executors = {
+            "upload": ThreadPoolExecutor(self.upload_concurrency),
+            "download": ThreadPoolExecutor(self.download_concurrency),
+            "ocr": ThreadPoolExecutor(self.ocr_concurrency),
+            "assemble": ThreadPoolExecutor(self.assemble_concurrency),
+        }
+        try:
+            uploaders = [
+                asyncio.create_task(self._upload_worker(loop, executors["upload"], upload_queue, download_queue))
+                for _ in range(self.upload_concurrency)
+            ]
+            downloader = asyncio.create_task(
+                self._download_worker(loop, executors["download"], download_queue, ocr_queue, assemble_queue)
+            )
+            ocr_workers = [
+                asyncio.create_task(self._ocr_worker(loop, executors["ocr"], ocr_queue))
+                for _ in range(self.ocr_concurrency)
+            ]
+            assemblers = [
+                asyncio.create_task(self._assemble_worker(loop, executors["assemble"], assemble_queue))
+                for _ in range(self.assemble_concurrency)
+            ]
+            await asyncio.gather(*uploaders)
+            await download_queue.put(_STOP)
+            await asyncio.gather(downloader, *ocr_workers, *assemblers)
+        finally:
+            for executor in executors.values():
+                executor.shutdown(wait=False)
+
+    async def _upload_worker(self, loop, executor, upload_queue, download_queue):
+        while True:
+            try:
+                file_path = upload_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            try:
+                data_list = await loop.run_in_executor(executor, self.parse_file, file_path)
+            except Exception as e:
+                print(f"{os.path.basename(file_path)} parsing failed")
+                print(e)
+                continue
+            print(f"{os.path.basename(file_path)} parsing completed")
+            await download_queue.put(DocumentJob(file_path, data_list, loop))
+
+    async def _download_worker(self, loop, executor, download_queue, ocr_queue, assemble_queue):
+        semaphore = asyncio.Semaphore(self.download_concurrency)
+        fetches = set()
+        while True:
+            job = await download_queue.get()
+            if job is _STOP:
+                break
+            for image_url in job.latex:
+                fetch = asyncio.create_task(
+                    self._fetch_image(loop, executor, semaphore, job, image_url, ocr_queue)
+                )
+                fetches.add(fetch)
+                fetch.add_done_callback(fetches.discard)
+            # The document is assembled once all of its images are recognized
+            await assemble_queue.put(job)
+        await asyncio.gather(*fetches)
+        for _ in range(self.ocr_concurrency):
+            await ocr_queue.put(_STOP)
+        for _ in range(self.assemble_concurrency):
+            await assemble_queue.put(_STOP)
+
+    async def _fetch_image(self, loop, executor, semaphore, job, image_url, ocr_queue):
+        async with semaphore:
+            try:
+                image_content = await loop.run_in_executor(executor, self.downloader.fetch, image_url)
+            except Exception as e:
+                job.latex[image_url].set_exception(e)
+                return
+        if image_content is None:
+            job.latex[image_url].set_result([])
+            return
+        await ocr_queue.put((job, image_url, image_content))
+
+    async def _ocr_worker(self, loop, executor, ocr_queue):
+        stopping = False
+        while not stopping:
+            item = await ocr_queue.get()
+            if item is _STOP:
+                return
+            # Batch whatever else is already waiting, across documents
+            batch = [item]
+            while len(batch) < self.ocr_batch_size:
+                try:
+                    item = ocr_queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                results = await loop.run_in_executor(
+                    executor, self.recognize, [image_content for _, _, image_content in batch]
+                )
+            except Exception as e:
+                for job, image_url, _ in batch:
+                    job.latex[image_url].set_exception(e)
+                continue
+            for (job, image_url, _), latex in zip(batch, results):
+                job.latex[image_url].set_result([latex])
+
+    async def _assemble_worker(self, loop, executor, assemble_queue):
+        while True:
+            job = await assemble_queue.get()
+            if job is _STOP:
+                return
+            try:
+                latex_results = await asyncio.gather(*job.latex.values())
+                latex_results = dict(zip(job.latex.keys(), latex_results))
+                await loop.run_in_executor(
+                    executor,
+                    self.save_document,
+                    job.file_path,
+                    job.data_list,
+                    self.output_directory,
+                    latex_results,
+                )
+                print(f"{job.name} document generated successfully!")
+            except Exception as e:
+                print(f"{job.name} document generation failed")
+                print(e)
+
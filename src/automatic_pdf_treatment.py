@@ -1,17 +1,24 @@
-import requests
+import asyncio
 import json
 import os
 import glob
-import tempfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from docx import Document
 from docx.shared import Pt
 from docx.enum.style import WD_STYLE_TYPE
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 from nougat_latex_processor import (
-    process_images_to_latex,
+    recognize_batch,
 )  # Import your nougat_latex_processor module
+from model_registry import default_registry
+from latex_cache import default_cache
+from textin_client import TEXTIN_API_URL, TextInClient
+from image_downloader import ImageDownloader
+from async_pipeline import AsyncPdfPipeline
+from batch_scheduler import BucketedBatchScheduler
+from continuous_decoder import ContinuousBatchDecoder
+from ocr_worker_pool import OcrWorkerPool
 
 # Load environment variables from .env file
 load_dotenv()
@@ -19,8 +26,36 @@ load_dotenv()
 # Get API credentials and directory paths from environment variables
 TEXTIN_API_ID = os.getenv("TEXTIN_API_ID")
 TEXTIN_API_CODE = os.getenv("TEXTIN_API_CODE")
+# Point this to a local TextInStubServer for offline load tests
+TEXTIN_BASE_URL = os.getenv("TEXTIN_BASE_URL", TEXTIN_API_URL)
+TEXTIN_POOL_SIZE = int(os.getenv("TEXTIN_POOL_SIZE", 10))
+TEXTIN_MAX_RETRIES = int(os.getenv("TEXTIN_MAX_RETRIES", 3))
+TEXTIN_RATE_LIMIT = float(os.getenv("TEXTIN_RATE_LIMIT", 0)) or None
+IMAGE_DOWNLOAD_WORKERS = int(os.getenv("IMAGE_DOWNLOAD_WORKERS", 8))
 INPUT_DIRECTORY = os.getenv("INPUT_DIRECTORY")
 OUTPUT_DIRECTORY = os.getenv("OUTPUT_DIRECTORY")
+# Optional on-disk tier of the LaTeX cache, shared across runs
+LATEX_CACHE_DIR = os.getenv("LATEX_CACHE_DIR")
+LATEX_CACHE_MAX_BYTES = int(os.getenv("LATEX_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# "thread" (one worker thread per file) or "async" (staged asyncio pipeline)
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "thread")
+PIPELINE_UPLOAD_CONCURRENCY = int(os.getenv("PIPELINE_UPLOAD_CONCURRENCY", 4))
+PIPELINE_DOWNLOAD_CONCURRENCY = int(os.getenv("PIPELINE_DOWNLOAD_CONCURRENCY", 16))
+PIPELINE_OCR_BATCH_SIZE = int(os.getenv("PIPELINE_OCR_BATCH_SIZE", 8))
+PIPELINE_ASSEMBLE_CONCURRENCY = int(os.getenv("PIPELINE_ASSEMBLE_CONCURRENCY", 2))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 8))
+# Run OCR in this many CPU worker processes instead of in-process (0 disables the pool)
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", 0))
+OCR_THREADS_PER_WORKER = int(os.getenv("OCR_THREADS_PER_WORKER", 0)) or None
+# In-process OCR backend: "batch" (recognize_batch on each image as it lands), "bucketed"
+# (BucketedBatchScheduler, grouping similar crops of every document) or "continuous"
+# (ContinuousBatchDecoder, refilling the slots of finished rows at every decoding step)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "batch")
+OCR_BATCH_SIZE = int(os.getenv("OCR_BATCH_SIZE", 8))
+OCR_MAX_WAIT = float(os.getenv("OCR_MAX_WAIT", 0.05))
+# OCR batches the async pipeline keeps in flight with a bucketed or continuous backend,
+# which regroups their images
+PIPELINE_OCR_CONCURRENCY = int(os.getenv("PIPELINE_OCR_CONCURRENCY", 4))
 
 
 # Read file content
@@ -29,41 +64,115 @@ def get_file_content(filePath):
         return fp.read()
 
 
+# Shared TextIn client, its connection pool is reused by every file
+def create_textin_client():
+    return TextInClient(
+        TEXTIN_API_ID,
+        TEXTIN_API_CODE,
+        base_url=TEXTIN_BASE_URL,
+        pool_size=TEXTIN_POOL_SIZE,
+        max_retries=TEXTIN_MAX_RETRIES,
+        rate_limit=TEXTIN_RATE_LIMIT,
+    )
+
+
 # PDF parsing
 class CommonOcr(object):
-    def __init__(self, img_path):
-        self._app_id = TEXTIN_API_ID
-        self._secret_code = TEXTIN_API_CODE
+    def __init__(self, img_path, client=None):
+        self._client = client if client is not None else textin_client
         self._img_path = img_path
 
     def recognize(self):
-        url = "https://api.textin.com/ai/service/v1/pdf_to_markdown?get_image=objects"
-        head = {"x-ti-app-id": self._app_id, "x-ti-secret-code": self._secret_code}
+        image = get_file_content(self._img_path)
+        return self._client.pdf_to_markdown(image)
+
+
+# Image downloads share the TextIn connection pool
+def create_image_downloader(client):
+    return ImageDownloader(
+        client.session,
+        max_workers=IMAGE_DOWNLOAD_WORKERS,
+        timeout=client.timeout,
+    )
+
+
+# Created in the main block only: the spawned OCR worker processes re-import this
+# module and must not start their own sessions and thread pools
+textin_client = None
+image_downloader = None
+# Model inference runs in the order downloads complete, on a single thread,
+# or on one thread per OCR worker process
+ocr_executor = None
+ocr_pool = None
+ocr_backend = None
+
+
+# Scheduler receiving the images directly, None for the "batch" backend
+def create_ocr_backend():
+    if OCR_BACKEND == "bucketed":
+        return BucketedBatchScheduler(
+            batch_size=OCR_BATCH_SIZE, max_wait=OCR_MAX_WAIT, cache=default_cache
+        )
+    if OCR_BACKEND == "continuous":
+        return ContinuousBatchDecoder(batch_size=OCR_BATCH_SIZE, cache=default_cache)
+    if OCR_BACKEND != "batch":
+        raise ValueError(f"Unknown OCR_BACKEND: {OCR_BACKEND}")
+    return None
+
+
+# Recognize one image held in memory
+def recognize_image_content(image_content):
+    if ocr_pool is not None:
+        return ocr_pool.recognize([image_content])
+    return recognize_batch([image_content], cache=default_cache)
+
+
+# Start downloading every image of a document, each one is sent to OCR as soon as it lands
+def prefetch_image_latex(list_name):
+    image_urls = [item["image_url"] for item in list_name if item["type"] == "image"]
+    downloads = image_downloader.prefetch(image_urls)
+    latex_futures = {}
+    for image_url, download in downloads.items():
+        latex_future = Future()
+        download.add_done_callback(
+            lambda download, latex_future=latex_future: submit_ocr(download, latex_future)
+        )
+        latex_futures[image_url] = latex_future
+    return latex_futures
+
+
+# Queue a finished download for OCR, the result ends up in latex_future
+def submit_ocr(download, latex_future):
+    try:
+        image_content = download.result()
+    except Exception as e:
+        latex_future.set_exception(e)
+        return
+    if image_content is None:
+        latex_future.set_result([])
+        return
+    if ocr_backend is not None:
+        # The backend batches the images of every document on its own thread
         try:
-            image = get_file_content(self._img_path)
-            result = requests.post(url, data=image, headers=head)
-            return result
+            ocr_future = ocr_backend.submit(image_content)
         except Exception as e:
-            return e
+            latex_future.set_exception(e)
+            return
+        ocr_future.add_done_callback(
+            lambda ocr_future: copy_future_result(ocr_future, latex_future, as_list=True)
+        )
+        return
+    ocr_future = ocr_executor.submit(recognize_image_content, image_content)
+    ocr_future.add_done_callback(lambda ocr_future: copy_future_result(ocr_future, latex_future))
 
 
-# Download image and save to local
-def download_and_save_image(image_url, save_dir):
-    response = requests.get(image_url)
-    if response.status_code == 200:
-        file_path = os.path.join(save_dir, os.path.basename(image_url))
-        with open(file_path, "wb") as file:
-            file.write(response.content)
-        return file_path
+def copy_future_result(source, target, as_list=False):
+    if source.exception() is not None:
+        target.set_exception(source.exception())
+    elif as_list:
+        target.set_result([source.result()])
     else:
-        print("Unable to download image")
-        return None
-
-
-# Delete local file
-def delete_file(file_path):
-    if os.path.exists(file_path):
-        os.remove(file_path)
+        target.set_result(source.result())
 
 
 # Create or get custom table and paragraph styles
@@ -196,10 +305,14 @@ def get_title_level(body_text):
     return title_level
 
 
-def docs_output(doc, list_name, temp_dir):
+def docs_output(doc, list_name, latex_results=None):
     is_main_body = 0
     title_level = []
     no_spacing_style = get_no_spacing_style(doc)  # Get "No Spacing" style
+    # Download and recognize all images while the text is being written,
+    # unless the caller already did it
+    if latex_results is None:
+        latex_results = prefetch_image_latex(list_name)
     for i in range(len(list_name)):
         # Text
         if list_name[i]["type"] == "paragraph":
@@ -235,18 +348,15 @@ def docs_output(doc, list_name, temp_dir):
         # Image
         elif list_name[i]["type"] == "image":
             image_url = list_name[i]["image_url"]
-            image_path = download_and_save_image(
-                image_url, temp_dir
-            )  # Download image and save to temporary directory
-            if image_path:
-                latex_results = process_images_to_latex(
-                    img_dir=temp_dir
-                )  # Process downloaded images
-                for latex in latex_results:
-                    doc.add_paragraph(
-                        latex, style=no_spacing_style
-                    )  # Add LaTeX code to document
-                delete_file(image_path)  # Delete downloaded image file
+            image_latex = latex_results[image_url]
+            if isinstance(image_latex, Future):
+                image_latex = (
+                    image_latex.result()
+                )  # Wait for the prefetched image to be recognized
+            for latex in image_latex:
+                doc.add_paragraph(
+                    latex, style=no_spacing_style
+                )  # Add LaTeX code to document
         # Table
         elif list_name[i]["type"] == "table":
             print("Writing table")
@@ -256,32 +366,41 @@ def docs_output(doc, list_name, temp_dir):
             print("New type found: " + list_name[i]["type"])
 
 
+# Send a file to TextIn and return its parsed detail list
+def parse_file(file_path):
+    pdf_result = CommonOcr(file_path).recognize()
+    data_dict = json.loads(pdf_result.text)
+    return data_dict["result"]["detail"]
+
+
+# Build the docx of a parsed file and save it to the output directory
+def save_document(file_path, data_list, output_directory, latex_results=None):
+    doc = Document()
+    docs_output(doc, data_list, latex_results)
+    output_file_path = os.path.join(
+        output_directory,
+        f"{os.path.splitext(os.path.basename(file_path))[0]}.docx",
+    )
+    doc.save(output_file_path)
+    return output_file_path
+
+
 # Process a single file
 def process_single_file(file_path, output_directory):
-    with tempfile.TemporaryDirectory() as temp_dir:
-        response = CommonOcr(file_path)
-        try:
-            pdf_result = response.recognize()
-            data_dict = json.loads(pdf_result.text)
-            data_list = data_dict["result"]["detail"]
-            print(f"{os.path.basename(file_path)} parsing completed")
-        except Exception as e:
-            print(f"{os.path.basename(file_path)} parsing failed")
-            print(e)
-            return
-
-        try:
-            doc = Document()
-            docs_output(doc, data_list, temp_dir)
-            output_file_path = os.path.join(
-                output_directory,
-                f"{os.path.splitext(os.path.basename(file_path))[0]}.docx",
-            )
-            doc.save(output_file_path)
-            print(f"{os.path.basename(file_path)} document generated successfully!")
-        except Exception as e:
-            print(f"{os.path.basename(file_path)} document generation failed")
-            print(e)
+    try:
+        data_list = parse_file(file_path)
+        print(f"{os.path.basename(file_path)} parsing completed")
+    except Exception as e:
+        print(f"{os.path.basename(file_path)} parsing failed")
+        print(e)
+        return
+
+    try:
+        save_document(file_path, data_list, output_directory)
+        print(f"{os.path.basename(file_path)} document generated successfully!")
+    except Exception as e:
+        print(f"{os.path.basename(file_path)} document generation failed")
+        print(e)
 
 
 # Process all files in the specified directory
@@ -301,6 +420,62 @@ def process_all_files_in_directory(input_directory, output_directory):
                 print(f"Error processing file: {e}")
 
 
+# Process all files in the specified directory with the staged asyncio pipeline
+def process_all_files_in_directory_async(input_directory, output_directory):
+    file_paths = [
+        file_path
+        for file_path in glob.glob(os.path.join(input_directory, "*"))
+        if os.path.isfile(file_path)
+    ]
+    recognize, ocr_concurrency = None, 1
+    if ocr_pool is not None:
+        recognize, ocr_concurrency = ocr_pool.recognize, OCR_WORKERS
+    elif ocr_backend is not None:
+        recognize, ocr_concurrency = ocr_backend.recognize, PIPELINE_OCR_CONCURRENCY
+    pipeline = AsyncPdfPipeline(
+        parse_file,
+        save_document,
+        image_downloader,
+        output_directory,
+        upload_concurrency=PIPELINE_UPLOAD_CONCURRENCY,
+        download_concurrency=PIPELINE_DOWNLOAD_CONCURRENCY,
+        ocr_batch_size=PIPELINE_OCR_BATCH_SIZE,
+        assemble_concurrency=PIPELINE_ASSEMBLE_CONCURRENCY,
+        queue_size=PIPELINE_QUEUE_SIZE,
+        recognize=recognize,
+        ocr_concurrency=ocr_concurrency,
+    )
+    asyncio.run(pipeline.run(file_paths))
+
+
 # Main function
 if __name__ == "__main__":
-    process_all_files_in_directory(INPUT_DIRECTORY, OUTPUT_DIRECTORY)
+    textin_client = create_textin_client()
+    image_downloader = create_image_downloader(textin_client)
+    ocr_executor = ThreadPoolExecutor(max_workers=max(1, OCR_WORKERS))
+    if OCR_WORKERS > 0:
+        # Each worker process loads the model and opens its LaTeX cache once when it starts
+        ocr_pool = OcrWorkerPool(
+            OCR_WORKERS,
+            OCR_THREADS_PER_WORKER,
+            cache_dir=LATEX_CACHE_DIR,
+            max_disk_bytes=LATEX_CACHE_MAX_BYTES,
+        )
+    else:
+        # Load the OCR model once before the worker threads start
+        default_registry.warm_up()
+        ocr_backend = create_ocr_backend()
+    if LATEX_CACHE_DIR:
+        default_cache.set_cache_dir(LATEX_CACHE_DIR, LATEX_CACHE_MAX_BYTES)
+    if PIPELINE_MODE == "async":
+        process_all_files_in_directory_async(INPUT_DIRECTORY, OUTPUT_DIRECTORY)
+    else:
+        process_all_files_in_directory(INPUT_DIRECTORY, OUTPUT_DIRECTORY)
+    print(f"LaTeX cache stats: {default_cache.stats()}")
+    if ocr_pool is not None:
+        ocr_pool.close()
+    if ocr_backend is not None:
+        ocr_backend.close()
+    ocr_executor.shutdown()
+    image_downloader.close()
+    textin_client.close()
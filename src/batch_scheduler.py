@@ -0,0 +1,175 @@
+import collections
+import threading
+import time
+from concurrent.futures import Future
+import torch
+from model_registry import DEFAULT_MODEL_PATH, get_model_bundle
+from nougat_latex_processor import (
+    decode_sequences,
+    generate_sequences,
+    load_image,
+    preprocess_images,
+)
+
+
+# Guess how many tokens an equation crop will decode to from its rescaled width
+def predict_output_length(latex_processor, image, tokens_per_pixel=0.25):
+    if image.height < latex_processor.maxH:
+        content_w, _ = latex_processor._get_target_size(image)
+    else:
+        content_w = min(
+            latex_processor.imgW,
+            latex_processor.get_aspect_ratio(image) * latex_processor.imgH,
+        )
+    return max(1, int(content_w * tokens_per_pixel))
+
+
+# One crop waiting in a bucket
+class PendingCrop(object):
+    __slots__ = ("pixel_values", "future", "cache_key", "enqueue_time")
+
+    def __init__(self, pixel_values, future, cache_key=None):
+        self.pixel_values = pixel_values
+        self.future = future
+        self.cache_key = cache_key
+        self.enqueue_time = time.monotonic()
+
+
+class BucketedBatchScheduler(object):
+    """Group pending equation crops by aspect ratio and predicted output length.
+
+    A bucket is flushed as soon as it holds `batch_size` crops, or when its oldest crop
+    has waited `max_wait` seconds, so similar crops share a batch without hurting tail
+    latency. Crops are decoded on a single background thread. When a `LatexCache` is given,
+    crops whose rescaled pixels were seen before are answered without being queued.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+        device_type="gpu",
+        dtype=torch.float32,
+        batch_size=8,
+        max_wait=0.05,
+        aspect_ratio_step=2.0,
+        length_step=32,
+        length_predictor=None,
+        cache=None,
+    ):
+        self.pretrained_model_name_or_path = pretrained_model_name_or_path
+        self.bundle = get_model_bundle(pretrained_model_name_or_path, device_type, dtype)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.aspect_ratio_step = aspect_ratio_step
+        self.length_step = length_step
+        self.length_predictor = length_predictor or (
+            lambda image: predict_output_length(self.bundle.latex_processor, image)
+        )
+        self.num_batches = 0
+        self.num_crops = 0
+
+        self._buckets = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def bucket_key(self, image):
+        aspect_ratio = self.bundle.latex_processor.get_aspect_ratio(image)
+        return (
+            int(aspect_ratio // self.aspect_ratio_step),
+            int(self.length_predictor(image) // self.length_step),
+        )
+
+    def submit(self, image):
+        """Queue an image (path, bytes or PIL image), returns a Future holding its LaTeX code."""
+        future = Future()
+        image = load_image(image)
+        # Preprocess on the caller thread so that several producers run it in parallel
+        rescaled = self.bundle.latex_processor._rescale(image)
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(rescaled, self.pretrained_model_name_or_path)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                future.set_result(cached)
+                return future
+        key = self.bucket_key(image)
+        pixel_values = preprocess_images(self.bundle.latex_processor, [rescaled], rescaled=True)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("scheduler is closed")
+            self._buckets.setdefault(key, collections.deque()).append(
+                PendingCrop(pixel_values, future, cache_key)
+            )
+            self._cond.notify()
+        return future
+
+    def recognize(self, images):
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._worker.join()
+
+    def _next_batch(self):
+        now = time.monotonic()
+        ready_key = None
+        oldest = None
+        for key, queue in self._buckets.items():
+            if len(queue) >= self.batch_size:
+                ready_key = key
+                break
+            expired = self._closed or now - queue[0].enqueue_time >= self.max_wait
+            if expired and (oldest is None or queue[0].enqueue_time < oldest):
+                ready_key, oldest = key, queue[0].enqueue_time
+        if ready_key is None:
+            return None
+        queue = self._buckets[ready_key]
+        batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+        if not queue:
+            del self._buckets[ready_key]
+        return batch
+
+    def _time_to_deadline(self):
+        if not self._buckets:
+            return None
+        oldest = min(queue[0].enqueue_time for queue in self._buckets.values())
+        return max(0.0, oldest + self.max_wait - time.monotonic())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+                while batch is None:
+                    if self._closed and not self._buckets:
+                        return
+                    self._cond.wait(timeout=self._time_to_deadline())
+                    batch = self._next_batch()
+            self._process(batch)
+
+    def _process(self, batch):
+        try:
+            pixel_values = torch.cat([crop.pixel_values for crop in batch])
+            sequences = generate_sequences(self.bundle, pixel_values)
+            results = decode_sequences(self.bundle.tokenizer, sequences)
+        except Exception as e:
+            for crop in batch:
+                crop.future.set_exception(e)
+            return
+        self.num_batches += 1
+        self.num_crops += len(batch)
+        for crop, result in zip(batch, results):
+            if self.cache is not None:
+                self.cache.put(crop.cache_key, result)
+            crop.future.set_result(result)
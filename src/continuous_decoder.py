@@ -0,0 +1,261 @@
+import queue
+import threading
+from concurrent.futures import Future
+import torch
+import torch.nn.functional as F
+from model_registry import DEFAULT_MODEL_PATH, get_model_bundle
+from nougat_latex_processor import decode_sequences, load_image, preprocess_images
+
+# Put on the queue by close() to stop the worker once running rows are done
+_STOP = object()
+
+
+# One sequence being decoded in a batch slot
+class DecodeRow(object):
+    __slots__ = ("future", "tokens", "cache_key")
+
+    def __init__(self, future, tokens, cache_key=None):
+        self.future = future
+        self.tokens = tokens
+        self.cache_key = cache_key
+
+    @property
+    def consumed(self):
+        # Tokens already fed to the decoder, i.e. real entries in the KV cache
+        return len(self.tokens) - 1
+
+
+class ContinuousBatchDecoder(object):
+    """Greedy decoder that keeps its batch full.
+
+    Rows that emit `eos_token_id` (or reach `max_length`) are removed from the decoder KV
+    cache right away and their slots are refilled with queued images on the next step.
+    New rows are left-padded in the self-attention cache and masked out, and the learned
+    position embeddings are corrected per row so every row sees its own positions. When a
+    `LatexCache` is given, images whose rescaled pixels were seen before are not decoded.
+    """
+
+    def __init__(
+        self,
+        pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+        device_type="gpu",
+        dtype=torch.float32,
+        batch_size=8,
+        max_length=None,
+        cache=None,
+    ):
+        self.pretrained_model_name_or_path = pretrained_model_name_or_path
+        self.bundle = get_model_bundle(pretrained_model_name_or_path, device_type, dtype)
+        self.cache = cache
+        self.batch_size = batch_size
+        self.max_length = max_length or self.bundle.model.config.decoder.max_length
+        self.num_steps = 0
+
+        self._decoder = self.bundle.model.decoder
+        self._reset_state()
+        self._queue = queue.Queue()
+        self._closed = False
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, image):
+        """Queue an image (path, bytes or PIL image), returns a Future holding its LaTeX code."""
+        if self._closed:
+            raise RuntimeError("decoder is closed")
+        future = Future()
+        image = self.bundle.latex_processor._rescale(load_image(image))
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self.cache.make_key(image, self.pretrained_model_name_or_path)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                future.set_result(cached)
+                return future
+        pixel_values = preprocess_images(self.bundle.latex_processor, [image], rescaled=True)
+        self._queue.put((pixel_values, future, cache_key))
+        return future
+
+    def recognize(self, images):
+        futures = [self.submit(image) for image in images]
+        return [future.result() for future in futures]
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._queue.put(_STOP)
+        self._worker.join()
+
+    """
+        Decode loop
+    """
+
+    def _reset_state(self):
+        self._rows = []
+        self._past = None
+        self._encoder_hidden_states = None
+        self._attention_mask = None
+
+    def _run(self):
+        stopping = False
+        with torch.no_grad():
+            while True:
+                items = []
+                # Block only when there is nothing left to decode
+                if not self._rows and not stopping:
+                    items.append(self._queue.get())
+                while len(self._rows) + len(items) < self.batch_size:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if _STOP in items:
+                    stopping = True
+                    items = [item for item in items if item is not _STOP]
+                try:
+                    if items:
+                        self._prefill(items)
+                    if self._rows:
+                        self._step()
+                except Exception as e:
+                    for row in self._rows:
+                        row.future.set_exception(e)
+                    for _, future, _ in items:
+                        if not future.done():
+                            future.set_exception(e)
+                    self._reset_state()
+                if stopping and not self._rows and self._queue.empty():
+                    return
+
+    def _encode(self, pixel_values):
+        model = self.bundle.model
+        encoder_hidden_states = model.encoder(pixel_values=pixel_values).last_hidden_state
+        if (
+            model.encoder.config.hidden_size != model.decoder.config.hidden_size
+            and model.decoder.config.cross_attention_hidden_size is None
+        ):
+            encoder_hidden_states = model.enc_to_dec_proj(encoder_hidden_states)
+        return encoder_hidden_states
+
+    def _select_tokens(self, logits):
+        logits = logits[:, -1, :].float()
+        logits[:, self.bundle.tokenizer.unk_token_id] = -float("inf")
+        return logits.argmax(dim=-1).tolist()
+
+    def _prefill(self, items):
+        # Encode the new images and feed them the start token on their own
+        bundle = self.bundle
+        pixel_values = torch.cat([pixel_values for pixel_values, _, _ in items])
+        encoder_hidden_states = self._encode(
+            pixel_values.to(device=bundle.device, dtype=bundle.dtype)
+        )
+        input_ids = torch.full(
+            (len(items), 1), bundle.tokenizer.bos_token_id, dtype=torch.long, device=bundle.device
+        )
+        outputs = self._decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            use_cache=True,
+            return_dict=True,
+        )
+        rows = [
+            DecodeRow(future, [bundle.tokenizer.bos_token_id, token], cache_key)
+            for (_, future, cache_key), token in zip(items, self._select_tokens(outputs.logits))
+        ]
+        self._append_rows(rows, outputs.past_key_values, encoder_hidden_states)
+        self._retire_finished()
+
+    def _append_rows(self, rows, past, encoder_hidden_states):
+        new_len = past[0][0].shape[2]
+        new_mask = torch.ones((len(rows), new_len), dtype=torch.long, device=self.bundle.device)
+        if not self._rows:
+            self._rows = rows
+            self._past = past
+            self._encoder_hidden_states = encoder_hidden_states
+            self._attention_mask = new_mask
+            return
+        # Left-pad the self-attention cache of the new rows up to the running length
+        pad = self._past[0][0].shape[2] - new_len
+        self._past = tuple(
+            tuple(
+                torch.cat([old, F.pad(new, (0, 0, pad, 0)) if i < 2 else new], dim=0)
+                for i, (old, new) in enumerate(zip(old_layer, new_layer))
+            )
+            for old_layer, new_layer in zip(self._past, past)
+        )
+        new_mask = F.pad(new_mask, (pad, 0))
+        self._attention_mask = torch.cat([self._attention_mask, new_mask], dim=0)
+        self._encoder_hidden_states = torch.cat(
+            [self._encoder_hidden_states, encoder_hidden_states], dim=0
+        )
+        self._rows = self._rows + rows
+
+    def _embed(self, input_ids, positions, cache_len):
+        # The decoder adds the embedding of position `cache_len` to every row, swap it for
+        # the embedding of each row's own position
+        decoder = self._decoder.get_decoder()
+        embed_positions = decoder.embed_positions
+        offset = getattr(embed_positions, "offset", 0)
+        inputs_embeds = decoder.embed_tokens(input_ids) * decoder.embed_scale
+        correction = (
+            embed_positions.weight[positions + offset] - embed_positions.weight[cache_len + offset]
+        )
+        return inputs_embeds + correction[:, None, :].to(inputs_embeds.dtype)
+
+    def _step(self):
+        device = self.bundle.device
+        cache_len = self._past[0][0].shape[2]
+        input_ids = torch.tensor(
+            [[row.tokens[-1]] for row in self._rows], dtype=torch.long, device=device
+        )
+        positions = torch.tensor([row.consumed for row in self._rows], device=device)
+        attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        outputs = self._decoder(
+            inputs_embeds=self._embed(input_ids, positions, cache_len),
+            attention_mask=attention_mask,
+            encoder_hidden_states=self._encoder_hidden_states,
+            past_key_values=self._past,
+            use_cache=True,
+            return_dict=True,
+        )
+        self._past = outputs.past_key_values
+        self._attention_mask = attention_mask
+        for row, token in zip(self._rows, self._select_tokens(outputs.logits)):
+            row.tokens.append(token)
+        self.num_steps += 1
+        self._retire_finished()
+
+    def _retire_finished(self):
+        tokenizer = self.bundle.tokenizer
+        keep = []
+        for i, row in enumerate(self._rows):
+            if row.tokens[-1] == tokenizer.eos_token_id or len(row.tokens) >= self.max_length:
+                result = decode_sequences(tokenizer, [row.tokens])[0]
+                if self.cache is not None:
+                    self.cache.put(row.cache_key, result)
+                row.future.set_result(result)
+            else:
+                keep.append(i)
+        if len(keep) == len(self._rows):
+            return
+        if not keep:
+            self._reset_state()
+            return
+        index = torch.tensor(keep, device=self.bundle.device)
+        self._rows = [self._rows[i] for i in keep]
+        self._past = tuple(tuple(t.index_select(0, index) for t in layer) for layer in self._past)
+        self._encoder_hidden_states = self._encoder_hidden_states.index_select(0, index)
+        self._attention_mask = self._attention_mask.index_select(0, index)
+        # Drop leading cache columns that none of the remaining rows attends to
+        trim = self._past[0][0].shape[2] - max(row.consumed for row in self._rows)
+        if trim > 0:
+            self._past = tuple(
+                (layer[0][:, :, trim:], layer[1][:, :, trim:]) + tuple(layer[2:])
+                for layer in self._past
+            )
+            self._attention_mask = self._attention_mask[:, trim:]
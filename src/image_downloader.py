@@ -0,0 +1,69 @@
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import requests
+
+
+class ImageDownloader(object):
+    """Download images concurrently over a shared session.
+
+    Bodies are streamed in chunks, either into memory (`fetch`) or to disk (`download`).
+    """
+
+    def __init__(self, session=None, max_workers=8, chunk_size=64 * 1024, timeout=(10, 60)):
+        self.session = session if session is not None else requests.Session()
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def download(self, image_url, save_dir, file_name=None):
+        file_name = file_name or os.path.basename(urlparse(image_url).path)
+        file_path = os.path.join(save_dir, file_name)
+        try:
+            with self.session.get(image_url, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print("Unable to download image")
+                    return None
+                with open(file_path, "wb") as file:
+                    for chunk in response.iter_content(chunk_size=self.chunk_size):
+                        file.write(chunk)
+        except requests.RequestException as e:
+            print(f"Unable to download image: {e}")
+            return None
+        return file_path
+
+    def fetch(self, image_url):
+        buffer = io.BytesIO()
+        try:
+            with self.session.get(image_url, stream=True, timeout=self.timeout) as response:
+                if response.status_code != 200:
+                    print("Unable to download image")
+                    return None
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    buffer.write(chunk)
+        except requests.RequestException as e:
+            print(f"Unable to download image: {e}")
+            return None
+        return buffer.getvalue()
+
+    def prefetch(self, image_urls, save_dir=None):
+        """Start downloading every url, returns {url: Future}.
+
+        Without `save_dir` each Future holds the image bytes, otherwise the saved path. It
+        holds None when the download failed.
+        """
+        futures = {}
+        for i, image_url in enumerate(image_urls):
+            if image_url in futures:
+                continue
+            if save_dir is None:
+                futures[image_url] = self._executor.submit(self.fetch, image_url)
+                continue
+            # Prefix with the position so urls sharing a basename don't collide
+            file_name = "{}_{}".format(i, os.path.basename(urlparse(image_url).path))
+            futures[image_url] = self._executor.submit(self.download, image_url, save_dir, file_name)
+        return futures
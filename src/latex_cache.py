@@ -0,0 +1,175 @@
+import collections
+import hashlib
+import os
+import threading
+
+
+class LatexCache(object):
+    """Content-addressed cache from rescaled image pixels to recognized LaTeX code.
+
+    Entries live in an in-memory LRU and, when `cache_dir` is set, in an on-disk tier. The
+    files of the disk tier are indexed in memory in least recently used order, and once
+    they exceed `max_disk_bytes` the oldest are evicted down to `disk_low_water` of it.
+    File reads and writes happen outside the lock, which only guards the indexes.
+    """
+
+    def __init__(
+        self, max_entries=4096, cache_dir=None, max_disk_bytes=256 * 1024 * 1024, disk_low_water=0.9
+    ):
+        self.max_entries = max_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.cache_dir = None
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_low_water = disk_low_water
+        # key -> (mtime, size) of the files on disk, least recently used first
+        self._disk_index = collections.OrderedDict()
+        self._disk_bytes = 0
+        self._writing = set()
+        if cache_dir is not None:
+            self.set_cache_dir(cache_dir, max_disk_bytes)
+
+    # Hash the decoded pixels so identical crops share an entry whatever their file name
+    @staticmethod
+    def make_key(image, namespace=""):
+        digest = hashlib.sha256()
+        digest.update(namespace.encode("utf-8"))
+        digest.update("{}:{}x{}".format(image.mode, image.width, image.height).encode("utf-8"))
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def set_cache_dir(self, cache_dir, max_disk_bytes=None):
+        os.makedirs(cache_dir, exist_ok=True)
+        # The directory is only walked once, later puts and evictions keep the index up to date
+        disk_index = collections.OrderedDict(
+            (key, (mtime, size)) for mtime, key, size in sorted(self._list_disk_entries(cache_dir))
+        )
+        with self._lock:
+            self.cache_dir = cache_dir
+            if max_disk_bytes is not None:
+                self.max_disk_bytes = max_disk_bytes
+            self._disk_index = disk_index
+            self._disk_bytes = sum(size for _, size in disk_index.values())
+            evicted = self._evict_disk()
+        self._remove_files(evicted)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], "{}.tex".format(key))
+
+    @staticmethod
+    def _list_disk_entries(cache_dir):
+        entries = []
+        for root, _, files in os.walk(cache_dir):
+            for file in files:
+                if not file.endswith(".tex"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, file[:-len(".tex")], stat.st_size))
+        return entries
+
+    def _remember(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return self._entries[key]
+            path = self._disk_path(key) if key in self._disk_index else None
+            if path is None:
+                self.misses += 1
+                return None
+        try:
+            with open(path, "r", encoding="utf-8") as fr:
+                value = fr.read()
+            # Touch the file so the index rebuilt by the next run sees it as recently used
+            os.utime(path)
+        except OSError:
+            value = None
+        with self._lock:
+            if value is None:
+                # Removed behind our back, or evicted meanwhile
+                entry = self._disk_index.pop(key, None)
+                if entry is not None:
+                    self._disk_bytes -= entry[1]
+                self.misses += 1
+                return None
+            if key in self._disk_index:
+                self._disk_index.move_to_end(key)
+            self.disk_hits += 1
+            self._remember(key, value)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._remember(key, value)
+            if self.cache_dir is None or key in self._disk_index or key in self._writing:
+                return
+            self._writing.add(key)
+            path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+            with open(tmp_path, "w", encoding="utf-8") as fw:
+                fw.write(value)
+            os.replace(tmp_path, path)
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+        with self._lock:
+            self._writing.discard(key)
+            if stat is None:
+                return
+            self._disk_index[key] = (stat.st_mtime, stat.st_size)
+            self._disk_bytes += stat.st_size
+            evicted = self._evict_disk()
+        self._remove_files(evicted)
+
+    def _evict_disk(self):
+        # Called with the lock held, returns the paths to remove once it is released
+        evicted = []
+        if self._disk_bytes <= self.max_disk_bytes:
+            return evicted
+        low_water = self.max_disk_bytes * self.disk_low_water
+        while self._disk_index and self._disk_bytes > low_water:
+            key, (_, size) = self._disk_index.popitem(last=False)
+            self._disk_bytes -= size
+            evicted.append(self._disk_path(key))
+        return evicted
+
+    @staticmethod
+    def _remove_files(paths):
+        for path in paths:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "memory_entries": len(self._entries),
+                "disk_entries": len(self._disk_index),
+                "disk_bytes": self._disk_bytes,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+            }
+
+
+# Shared cache used by process_images_to_latex
+default_cache = LatexCache()
@@ -0,0 +1,185 @@
+import threading
+import torch
+from PIL import Image
+from safetensors.torch import load_file
+from transformers import VisionEncoderDecoderConfig, VisionEncoderDecoderModel
+from transformers.modeling_utils import no_init_weights
+from transformers.models.nougat import NougatTokenizerFast
+from transformers.utils import cached_file
+from nougat_latex import NougatLaTexProcessor
+
+DEFAULT_MODEL_PATH = "Norm/nougat-latex-base"
+
+
+# Resolve the user facing device type ("gpu"/"cpu"/"cuda:1"...) to a torch device
+def resolve_device(device_type="gpu"):
+    if isinstance(device_type, torch.device):
+        return device_type
+    if device_type == "gpu":
+        return torch.device("cuda:0")
+    return torch.device(device_type)
+
+
+# Load a model whose parameters stay backed by the memory-mapped safetensors file, so
+# processes loading the same file share its pages instead of each holding a copy
+def load_mmap_model(pretrained_model_name_or_path):
+    weights_path = cached_file(
+        pretrained_model_name_or_path,
+        "model.safetensors",
+        _raise_exceptions_for_missing_entries=False,
+    )
+    if weights_path is None:
+        return VisionEncoderDecoderModel.from_pretrained(pretrained_model_name_or_path)
+    config = VisionEncoderDecoderConfig.from_pretrained(pretrained_model_name_or_path)
+    with no_init_weights():
+        model = VisionEncoderDecoderModel(config)
+    # assign=True keeps the mmap-backed tensors instead of copying them into the model
+    missing_keys, _ = model.load_state_dict(load_file(weights_path), strict=False, assign=True)
+    model.tie_weights()
+    # Tied weights are only saved once and buffers are built by the model itself, any other
+    # missing parameter would keep the uninitialised memory left by no_init_weights
+    missing_keys = set(missing_keys)
+    parameters = dict(model.named_parameters(remove_duplicate=False))
+    loaded = {id(parameter) for name, parameter in parameters.items() if name not in missing_keys}
+    uninitialized = [
+        name
+        for name, parameter in parameters.items()
+        if name in missing_keys and id(parameter) not in loaded
+    ]
+    if uninitialized:
+        raise RuntimeError(
+            "{} is missing the weights of {}".format(
+                weights_path, ", ".join(sorted(uninitialized))
+            )
+        )
+    return model
+
+
+# Everything needed to run inference with one model
+class ModelBundle(object):
+    def __init__(self, model, tokenizer, latex_processor, device, dtype):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.latex_processor = latex_processor
+        self.device = device
+        self.dtype = dtype
+
+
+# Process-wide cache of loaded models, keyed by (model path, device, dtype)
+class ModelRegistry(object):
+    def __init__(self, mmap_weights=False):
+        # Only used for float32 models on CPU, any dtype/device move copies the weights
+        self.mmap_weights = mmap_weights
+        self._bundles = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_key(pretrained_model_name_or_path, device_type, dtype):
+        return pretrained_model_name_or_path, str(resolve_device(device_type)), dtype
+
+    def _get_key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def _load(self, pretrained_model_name_or_path, device, dtype):
+        # Initialize model
+        if self.mmap_weights and device.type == "cpu" and dtype == torch.float32:
+            model = load_mmap_model(pretrained_model_name_or_path)
+        else:
+            model = VisionEncoderDecoderModel.from_pretrained(pretrained_model_name_or_path)
+            model = model.to(device=device, dtype=dtype)
+        model.eval()
+
+        # Initialize processor
+        tokenizer = NougatTokenizerFast.from_pretrained(pretrained_model_name_or_path)
+        latex_processor = NougatLaTexProcessor.from_pretrained(
+            pretrained_model_name_or_path
+        )
+        return ModelBundle(model, tokenizer, latex_processor, device, dtype)
+
+    def get(
+        self,
+        pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+        device_type="gpu",
+        dtype=torch.float32,
+    ):
+        """Return the bundle for the given key, loading it on first use."""
+        key = self._make_key(pretrained_model_name_or_path, device_type, dtype)
+        bundle = self._bundles.get(key)
+        if bundle is not None:
+            return bundle
+        # Only one thread loads a given key, the others wait for its result
+        with self._get_key_lock(key):
+            bundle = self._bundles.get(key)
+            if bundle is None:
+                bundle = self._load(
+                    pretrained_model_name_or_path, resolve_device(device_type), dtype
+                )
+                with self._lock:
+                    self._bundles[key] = bundle
+        return bundle
+
+    def warm_up(
+        self,
+        pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+        device_type="gpu",
+        dtype=torch.float32,
+        run_dummy_inference=True,
+    ):
+        """Load the bundle eagerly and optionally run one short generate call."""
+        bundle = self.get(pretrained_model_name_or_path, device_type, dtype)
+        if run_dummy_inference:
+            image = Image.new(
+                "RGB", (bundle.latex_processor.imgW, bundle.latex_processor.imgH), "white"
+            )
+            pixel_values = bundle.latex_processor(image, return_tensors="pt").pixel_values
+            decoder_input_ids = torch.full(
+                (1, 1), bundle.tokenizer.bos_token_id, dtype=torch.long
+            )
+            with torch.no_grad():
+                bundle.model.generate(
+                    pixel_values.to(device=bundle.device, dtype=bundle.dtype),
+                    decoder_input_ids=decoder_input_ids.to(bundle.device),
+                    max_length=2,
+                    pad_token_id=bundle.tokenizer.pad_token_id,
+                    eos_token_id=bundle.tokenizer.eos_token_id,
+                )
+        return bundle
+
+    def evict(self, pretrained_model_name_or_path=None, device_type=None, dtype=None):
+        """Drop every loaded bundle matching the given (partial) key."""
+        device = str(resolve_device(device_type)) if device_type is not None else None
+        with self._lock:
+            evicted = [
+                key
+                for key in self._bundles
+                if (pretrained_model_name_or_path is None or key[0] == pretrained_model_name_or_path)
+                and (device is None or key[1] == device)
+                and (dtype is None or key[2] == dtype)
+            ]
+            for key in evicted:
+                del self._bundles[key]
+                self._key_locks.pop(key, None)
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        return len(evicted)
+
+    def clear(self):
+        return self.evict()
+
+    def loaded_keys(self):
+        with self._lock:
+            return list(self._bundles.keys())
+
+
+# Shared registry used by the conversion pipeline
+default_registry = ModelRegistry()
+
+
+def get_model_bundle(
+    pretrained_model_name_or_path=DEFAULT_MODEL_PATH, device_type="gpu", dtype=torch.float32
+):
+    return default_registry.get(pretrained_model_name_or_path, device_type, dtype)
@@ -2,27 +2,103 @@
 # create: @time: 10/8/23 11:55
 
 import re
+from functools import lru_cache
+
+TEXT_REG = re.compile(r'(\\(operatorname|mathrm|text|mathbf)\s?\*? {.*?})')
+LETTER = '[a-zA-Z]'
+NOLETTER = r'[\W_^\d]'
+LETTER_REG = re.compile(LETTER)
+NOLETTER_REG = re.compile(NOLETTER)
+# whole whitespace runs other than single spaces
+IRREGULAR_WHITESPACE_REG = re.compile(r'\s{2,}|[^\S ]')
+# a whitespace character followed by a different one
+MIXED_WHITESPACE_REG = re.compile(r'(\s)(?!\1)\s')
+# a single space dropped by the fixed point: noletter (not a backslash) before and letter or noletter after,
+# or letter before and noletter after
+REMOVABLE_SPACE_REG = re.compile(
+    r' (?:(?<=[^\w\s\\] |[_\d] )(?=[a-zA-Z_\d]|[^\w\s])|(?<=[a-zA-Z] )(?=[_\d]|[^\w\s]))')
+NOLETTER_NOLETTER_REG = re.compile(r'(?!\\ )(%s)\s+?(%s)' % (NOLETTER, NOLETTER))
+NOLETTER_LETTER_REG = re.compile(r'(?!\\ )(%s)\s+?(%s)' % (NOLETTER, LETTER))
+LETTER_NOLETTER_REG = re.compile(r'(%s)\s+?(%s)' % (LETTER, NOLETTER))
 
-def process_raw_latex_code(s: str):
-    """Remove unnecessary whitespace from LaTeX code.
+
+def legacy_process_raw_latex_code(s: str):
+    """Reference implementation of `process_raw_latex_code`, repeating three substitutions until a fixed point.
 
     Args:
         s (str): Input string
 
     Returns:
-        str: Processed image
+        str: Processed LaTeX code
     """
-    text_reg = r'(\\(operatorname|mathrm|text|mathbf)\s?\*? {.*?})'
-    letter = '[a-zA-Z]'
-    noletter = '[\W_^\d]'
-    names = [x[0].replace(' ', '') for x in re.findall(text_reg, s)]
-    s = re.sub(text_reg, lambda match: str(names.pop(0)), s)
+    names = [x[0].replace(' ', '') for x in TEXT_REG.findall(s)]
+    s = TEXT_REG.sub(lambda match: str(names.pop(0)), s)
     news = s
     while True:
         s = news
-        news = re.sub(r'(?!\\ )(%s)\s+?(%s)' % (noletter, noletter), r'\1\2', s)
-        news = re.sub(r'(?!\\ )(%s)\s+?(%s)' % (noletter, letter), r'\1\2', news)
-        news = re.sub(r'(%s)\s+?(%s)' % (letter, noletter), r'\1\2', news)
+        news = NOLETTER_NOLETTER_REG.sub(r'\1\2', s)
+        news = NOLETTER_LETTER_REG.sub(r'\1\2', news)
+        news = LETTER_NOLETTER_REG.sub(r'\1\2', news)
         if news == s:
             break
-    return s
\ No newline at end of file
+    return s
+
+
+def _char_type(c):
+    if c is None:
+        return None
+    if LETTER_REG.match(c):
+        return 'letter'
+    if NOLETTER_REG.match(c):
+        return 'noletter'
+    return None
+
+
+def _kept_whitespace(before, run, after):
+    """Number of characters of the whitespace run `run` left by the fixed point of the legacy substitutions."""
+    before_type, after_type = _char_type(before), _char_type(after)
+    # `(?!\\ )` stops a backslash from absorbing the space that follows it
+    if before == '\\' and run[0] == ' ':
+        before_type = None
+    if before_type is None and after_type is None:
+        # only whitespace-to-whitespace substitutions apply, they stop at two characters
+        return min(len(run), 2)
+    if (before_type == 'noletter' and after_type is not None) or \
+            (before_type == 'letter' and after_type == 'noletter'):
+        return 0
+    return 1
+
+
+def _reduce_whitespace_run(match):
+    start, end = match.span()
+    s, run = match.string, match.group()
+    before = s[start - 1] if start > 0 else None
+    after = s[end] if end < len(s) else None
+    return run[:_kept_whitespace(before, run, after)]
+
+
+def _process_raw_latex_code(s):
+    s = TEXT_REG.sub(lambda match: match.group(1).replace(' ', ''), s)
+    if IRREGULAR_WHITESPACE_REG.search(s):
+        if MIXED_WHITESPACE_REG.search(s):
+            # which character of a mixed run survives depends on the substitution order
+            return legacy_process_raw_latex_code(s)
+        s = IRREGULAR_WHITESPACE_REG.sub(_reduce_whitespace_run, s)
+    # runs are single spaces now, or reduced runs that are kept as they are
+    return REMOVABLE_SPACE_REG.sub('', s)
+
+
+@lru_cache(maxsize=65536)
+def process_raw_latex_code(s: str):
+    """Remove unnecessary whitespace from LaTeX code.
+
+    Gives the same result as `legacy_process_raw_latex_code` in a single pass over the whitespace runs, results
+    are memoized for repeated strings.
+
+    Args:
+        s (str): Input string
+
+    Returns:
+        str: The LaTeX code with its whitespace normalized
+    """
+    return _process_raw_latex_code(s)
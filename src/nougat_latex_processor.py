@@ -1,76 +1,140 @@
 # Save this as nougat_latex_processor.py
 
+import io
 import os
 import torch
 from PIL import Image
-from transformers import VisionEncoderDecoderModel
-from transformers.models.nougat import NougatTokenizerFast
 from nougat_latex.util import process_raw_latex_code
-from nougat_latex import NougatLaTexProcessor
+from model_registry import DEFAULT_MODEL_PATH, get_model_bundle
+from latex_cache import default_cache
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".gif")
 
-def process_images_to_latex(
-    img_dir, pretrained_model_name_or_path="Norm/nougat-latex-base", device_type="gpu"
-):
-    # Set device
-    device = torch.device("cuda:0" if device_type == "gpu" else "cpu")
 
-    # Initialize model
-    model = VisionEncoderDecoderModel.from_pretrained(pretrained_model_name_or_path).to(
-        device
-    )
+# Open an image path or encoded bytes (or take a PIL image as is) in RGB mode
+def load_image(image):
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = Image.open(io.BytesIO(image))
+    elif not isinstance(image, Image.Image):
+        image = Image.open(image)
+    if not image.mode == "RGB":
+        image = image.convert("RGB")
+    return image
+
+
+# Preprocess several images together into one pixel_values tensor
+def preprocess_images(latex_processor, images, rescaled=False):
+    if rescaled:
+        return latex_processor.preprocess_batch(images, return_tensors="pt").pixel_values
+    return latex_processor(images, batched=True, return_tensors="pt").pixel_values
 
-    # Initialize processor
-    tokenizer = NougatTokenizerFast.from_pretrained(pretrained_model_name_or_path)
-    latex_processor = NougatLaTexProcessor.from_pretrained(
-        pretrained_model_name_or_path
+
+# Run greedy generation for a whole batch of pixel_values
+def generate_sequences(bundle, pixel_values, max_length=None):
+    model = bundle.model
+    tokenizer = bundle.tokenizer
+    decoder_input_ids = torch.full(
+        (pixel_values.shape[0], 1), tokenizer.bos_token_id, dtype=torch.long
     )
+    with torch.no_grad():
+        outputs = model.generate(
+            pixel_values.to(device=bundle.device, dtype=bundle.dtype),
+            decoder_input_ids=decoder_input_ids.to(bundle.device),
+            max_length=max_length or model.config.decoder.max_length,
+            early_stopping=True,
+            pad_token_id=tokenizer.pad_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            use_cache=True,
+            num_beams=1,
+            bad_words_ids=[[tokenizer.unk_token_id]],
+            return_dict_in_generate=True,
+        )
+    return outputs.sequences
+
 
+# Decode generated ids and clean them up into LaTeX code
+def decode_sequences(tokenizer, sequences):
     results = []
+    for sequence in tokenizer.batch_decode(sequences):
+        sequence = (
+            sequence.replace(tokenizer.eos_token, "")
+            .replace(tokenizer.pad_token, "")
+            .replace(tokenizer.bos_token, "")
+        )
+        results.append(process_raw_latex_code(sequence))
+    return results
 
-    # Process all images in the specified directory
-    for filename in os.listdir(img_dir):
-        if filename.endswith((".png", ".jpg", ".jpeg", ".bmp", ".gif")):
-            img_path = os.path.join(img_dir, filename)
-            image = Image.open(img_path)
-            if not image.mode == "RGB":
-                image = image.convert("RGB")
-
-            # Process image
-            pixel_values = latex_processor(image, return_tensors="pt").pixel_values
-            task_prompt = tokenizer.bos_token
-            decoder_input_ids = tokenizer(
-                task_prompt, add_special_tokens=False, return_tensors="pt"
-            ).input_ids
-
-            # Generate LaTeX code
-            with torch.no_grad():
-                outputs = model.generate(
-                    pixel_values.to(device),
-                    decoder_input_ids=decoder_input_ids.to(device),
-                    max_length=model.config.decoder.max_length,
-                    early_stopping=True,
-                    pad_token_id=tokenizer.pad_token_id,
-                    eos_token_id=tokenizer.eos_token_id,
-                    use_cache=True,
-                    num_beams=1,
-                    bad_words_ids=[[tokenizer.unk_token_id]],
-                    return_dict_in_generate=True,
-                )
-
-            # Decode and process the output
-            sequence = tokenizer.batch_decode(outputs.sequences)[0]
-            sequence = (
-                sequence.replace(tokenizer.eos_token, "")
-                .replace(tokenizer.pad_token, "")
-                .replace(tokenizer.bos_token, "")
-            )
-            sequence = process_raw_latex_code(sequence)
-            results.append(sequence)
 
+def recognize_batch(
+    images,
+    batch_size=8,
+    pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+    device_type="gpu",
+    dtype=torch.float32,
+    cache=None,
+):
+    """Recognize a list of images, one generate call per batch.
+
+    Images can be file paths, encoded bytes or PIL images, so downloaded images can be
+    handed over in memory without going through a temporary file.
+
+    Results are returned in the same order as the input images. When a `LatexCache` is
+    given, images whose rescaled pixels were seen before skip the model entirely.
+    """
+    bundle = get_model_bundle(pretrained_model_name_or_path, device_type, dtype)
+    results = [None] * len(images)
+
+    # Look up every image in the cache, only the misses are sent to the model
+    pending = []
+    for i, image in enumerate(images):
+        image = bundle.latex_processor._rescale(load_image(image))
+        key = None
+        if cache is not None:
+            key = cache.make_key(image, pretrained_model_name_or_path)
+            cached = cache.get(key)
+            if cached is not None:
+                results[i] = cached
+                continue
+        pending.append((i, image, key))
+
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start : start + batch_size]
+        pixel_values = preprocess_images(
+            bundle.latex_processor, [image for _, image, _ in batch], rescaled=True
+        )
+        sequences = generate_sequences(bundle, pixel_values)
+        for (i, _, key), result in zip(batch, decode_sequences(bundle.tokenizer, sequences)):
+            results[i] = result
+            if cache is not None:
+                cache.put(key, result)
     return results
 
 
+def process_images_to_latex(
+    img_dir,
+    pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+    device_type="gpu",
+    dtype=torch.float32,
+    batch_size=8,
+    cache=default_cache,
+):
+    # Collect all images in the specified directory
+    img_paths = [
+        os.path.join(img_dir, filename)
+        for filename in os.listdir(img_dir)
+        if filename.endswith(IMAGE_EXTENSIONS)
+    ]
+
+    return recognize_batch(
+        img_paths,
+        batch_size=batch_size,
+        pretrained_model_name_or_path=pretrained_model_name_or_path,
+        device_type=device_type,
+        dtype=dtype,
+        cache=cache,
+    )
+
+
 # This allows the function to be called directly or imported elsewhere
 if __name__ == "__main__":
     # Example usage:
@@ -0,0 +1,93 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from latex_cache import LatexCache
+from model_registry import DEFAULT_MODEL_PATH, default_registry
+from nougat_latex_processor import recognize_batch
+
+# Set in each worker process by _init_worker
+_worker_model_path = None
+_worker_cache = None
+
+
+def _init_worker(pretrained_model_name_or_path, threads_per_worker, cache_dir, max_disk_bytes):
+    global _worker_model_path, _worker_cache
+    # Pin the intra-op pool so workers don't oversubscribe the cores
+    torch.set_num_threads(threads_per_worker)
+    torch.set_num_interop_threads(1)
+    _worker_model_path = pretrained_model_name_or_path
+    _worker_cache = LatexCache(cache_dir=cache_dir, max_disk_bytes=max_disk_bytes)
+    default_registry.mmap_weights = True
+    default_registry.warm_up(pretrained_model_name_or_path, device_type="cpu")
+
+
+def _recognize_in_worker(images, batch_size):
+    return recognize_batch(
+        images,
+        batch_size=batch_size,
+        pretrained_model_name_or_path=_worker_model_path,
+        device_type="cpu",
+        cache=_worker_cache,
+    )
+
+
+class OcrWorkerPool(object):
+    """CPU OCR on a pool of worker processes.
+
+    Every worker loads the model once at start-up, memory-mapping the safetensors weights
+    so that their pages are shared between workers, and pins its torch thread count.
+    Batches of images (paths or encoded bytes) reach the workers over the pool's queue.
+
+    Every worker also has its own `LatexCache`. With `cache_dir` their disk tiers share the
+    directory, each worker trimming it to `max_disk_bytes` by its own index of the files.
+    """
+
+    def __init__(
+        self,
+        num_workers=None,
+        threads_per_worker=None,
+        pretrained_model_name_or_path=DEFAULT_MODEL_PATH,
+        batch_size=8,
+        cache_dir=None,
+        max_disk_bytes=256 * 1024 * 1024,
+    ):
+        cpu_count = os.cpu_count() or 1
+        self.num_workers = num_workers or max(1, cpu_count // 4)
+        self.threads_per_worker = threads_per_worker or max(1, cpu_count // self.num_workers)
+        self.batch_size = batch_size
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(
+                pretrained_model_name_or_path,
+                self.threads_per_worker,
+                cache_dir,
+                max_disk_bytes,
+            ),
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def submit(self, images):
+        """Send one batch to a worker, returns a Future of its LaTeX results."""
+        return self._executor.submit(_recognize_in_worker, list(images), self.batch_size)
+
+    def recognize(self, images):
+        """Split images into batches spread over the workers, results keep the input order."""
+        futures = [
+            self.submit(images[start : start + self.batch_size])
+            for start in range(0, len(images), self.batch_size)
+        ]
+        results = []
+        for future in futures:
+            results.extend(future.result())
+        return results
+
+    def close(self):
+        self._executor.shutdown(wait=True)
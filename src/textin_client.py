@@ -0,0 +1,212 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+TEXTIN_API_URL = "https://api.textin.com"
+PDF_TO_MARKDOWN_PATH = "/ai/service/v1/pdf_to_markdown"
+
+
+# Token bucket shared by all threads using one client
+class RateLimiter(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or max(1, rate))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class TextInClient(object):
+    """Pooled, retrying HTTP client for the TextIn API.
+
+    One `requests.Session` is shared by all threads, with a connection pool of
+    `pool_size`, (connect, read) timeouts, exponential backoff on connection errors and
+    retryable status codes, and an optional requests-per-second limit.
+    """
+
+    def __init__(
+        self,
+        app_id,
+        secret_code,
+        base_url=TEXTIN_API_URL,
+        pool_size=10,
+        connect_timeout=10,
+        read_timeout=300,
+        max_retries=3,
+        backoff_factor=1.0,
+        rate_limit=None,
+    ):
+        self._app_id = app_id
+        self._secret_code = secret_code
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+
+        retry = Retry(
+            total=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(["GET", "POST"]),
+            respect_retry_after_header=True,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Credentials go on the TextIn requests only, the session is shared with
+        # downloads from other hosts
+        self._auth_headers = {
+            "x-ti-app-id": self._app_id or "",
+            "x-ti-secret-code": self._secret_code or "",
+        }
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def request(self, method, url, **kwargs):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        kwargs.setdefault("timeout", self.timeout)
+        response = self.session.request(method, url, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def pdf_to_markdown(self, file_content, get_image="objects"):
+        url = "{}{}".format(self.base_url, PDF_TO_MARKDOWN_PATH)
+        return self.request(
+            "POST", url, params={"get_image": get_image}, data=file_content, headers=self._auth_headers
+        )
+
+
+"""
+    Stub server for offline load tests
+"""
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if not self.path.startswith(PDF_TO_MARKDOWN_PATH):
+            self.send_error(404)
+            return
+        time.sleep(server.latency)
+        self._send(json.dumps(server.make_result()).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        server = self.server
+        if not self.path.startswith("/images/") or server.image_content is None:
+            self.send_error(404)
+            return
+        time.sleep(server.latency)
+        self._send(server.image_content, "image/png")
+
+
+class TextInStubServer(ThreadingHTTPServer):
+    """Local stand-in for the TextIn API, returning a canned pdf_to_markdown result.
+
+    When `image_path` is given, every result also references `num_images` image objects
+    served by the stub itself, so the whole download and OCR path can run offline.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self, host="127.0.0.1", port=0, latency=0.0, num_paragraphs=20, image_path=None, num_images=5
+    ):
+        super(TextInStubServer, self).__init__((host, port), StubRequestHandler)
+        self.latency = latency
+        self.num_paragraphs = num_paragraphs
+        self.num_images = num_images if image_path else 0
+        self.image_content = None
+        if image_path:
+            with open(image_path, "rb") as fr:
+                self.image_content = fr.read()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def make_result(self):
+        detail = [
+            {"type": "paragraph", "content": 0, "outline_level": 0, "text": "Stub document"},
+        ]
+        for i in range(self.num_paragraphs):
+            detail.append(
+                {"type": "paragraph", "content": 0, "outline_level": -1, "text": "Paragraph {}".format(i)}
+            )
+        for i in range(self.num_images):
+            detail.append(
+                {"type": "image", "image_url": "{}/images/{}.png".format(self.base_url, i)}
+            )
+        return {"code": 200, "result": {"detail": detail}}
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+
+def parse_option():
+    parser = argparse.ArgumentParser(description="TextIn stub server for offline load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--num_paragraphs", type=int, default=20)
+    parser.add_argument("--image_path", default=None)
+    parser.add_argument("--num_images", type=int, default=5)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_option()
+    server = TextInStubServer(
+        args.host, args.port, args.latency, args.num_paragraphs, args.image_path, args.num_images
+    )
+    print(f"TextIn stub server listening on {server.base_url}")
+    server.serve_forever()
@@ -0,0 +1,72 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/20
+
+import os
+import sys
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+import time
+import numpy as np
+from nougat_latex.image_processing_nougat import NougatImageProcessor
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='compare crop_margin bounding box implementations')
+    parser.add_argument('--height', default=2200, type=int)
+    parser.add_argument('--width', default=1700, type=int)
+    parser.add_argument('--num_images', default=8, type=int)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def make_pages(num_images, height, width, seed):
+    # white pages with random dark text blocks inside a margin
+    rng = np.random.default_rng(seed)
+    pages = np.full((num_images, height, width), 255, dtype=np.uint8)
+    for page in pages:
+        top, left = rng.integers(50, 300, size=2)
+        bottom, right = height - rng.integers(50, 300), width - rng.integers(50, 300)
+        for _ in range(200):
+            y, x = rng.integers(top, bottom - 20), rng.integers(left, right - 200)
+            page[y:y + 20, x:x + rng.integers(20, 200)] = rng.integers(0, 120)
+    return pages
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+    processor = NougatImageProcessor()
+    masks = make_pages(args.num_images, args.height, args.width, args.seed) < 200
+
+    nonzero_time, nonzero_rects = timeit(
+        lambda: [processor.python_bounding_rect(processor.python_find_non_zero(mask)) for mask in masks],
+        args.repeat)
+    projection_time, projection_rects = timeit(
+        lambda: [processor.projection_bounding_rect(mask) for mask in masks], args.repeat)
+    batch_time, batch_rects = timeit(lambda: processor.batch_projection_bounding_rect(masks), args.repeat)
+
+    expected = [tuple(int(v) for v in rect) for rect in nonzero_rects]
+    assert expected == projection_rects, 'projection bounding rect differs from find_non_zero'
+    assert expected == [tuple(rect) for rect in batch_rects.tolist()], 'batched bounding rect differs'
+
+    print('{} pages of {}x{}'.format(args.num_images, args.height, args.width))
+    print('find_non_zero + bounding_rect: {:.2f} ms'.format(nonzero_time * 1000))
+    print('row/column projections:        {:.2f} ms ({:.1f}x)'.format(
+        projection_time * 1000, nonzero_time / projection_time))
+    print('batched projections:           {:.2f} ms ({:.1f}x)'.format(
+        batch_time * 1000, nonzero_time / batch_time))
+
+
+if __name__ == '__main__':
+    main(init_args())
@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/21
+
+import os
+import sys
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+import random
+import time
+from nougat_latex.util import legacy_process_raw_latex_code, process_raw_latex_code, _process_raw_latex_code
+
+TOKENS = ['\\frac', '{', '}', '^', '_', 'x', 'y', '2', '1', '+', '-', '=', '(', ')', '\\alpha', '\\sum', '\\,',
+          '\\mathrm { d }', '\\operatorname { s i n }', '\\text { i f }', '\\left(', '\\right)', '\\ ']
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='compare process_raw_latex_code implementations')
+    parser.add_argument('--equations', default=None, type=str, help='math.txt with one equation per line')
+    parser.add_argument('--num_equations', default=20000, type=int, help='synthetic equations without --equations')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def make_equations(num_equations, seed):
+    # space separated token sequences, like the im2latex labels
+    rng = random.Random(seed)
+    return [' '.join(rng.choice(TOKENS) for _ in range(rng.randint(5, 120))) for _ in range(num_equations)]
+
+
+def timeit(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(args):
+    if args.equations is not None:
+        with open(args.equations, encoding='utf-8') as f:
+            equations = f.read().split('\n')
+    else:
+        equations = make_equations(args.num_equations, args.seed)
+
+    legacy_time, expected = timeit(lambda: [legacy_process_raw_latex_code(eq) for eq in equations], args.repeat)
+    single_pass_time, results = timeit(lambda: [_process_raw_latex_code(eq) for eq in equations], args.repeat)
+    mismatches = [eq for eq, a, b in zip(equations, expected, results) if a != b]
+    assert not mismatches, 'single pass output differs for {} equations, e.g. {!r}'.format(
+        len(mismatches), mismatches[0])
+
+    process_raw_latex_code.cache_clear()
+    cold_time, cached = timeit(lambda: [process_raw_latex_code(eq) for eq in equations], 1)
+    warm_time, cached = timeit(lambda: [process_raw_latex_code(eq) for eq in equations], args.repeat)
+    assert cached == expected, 'memoized output differs'
+
+    print('{} equations, identical output'.format(len(equations)))
+    print('legacy fixed point loop: {:.2f} ms'.format(legacy_time * 1000))
+    print('single pass:             {:.2f} ms ({:.1f}x)'.format(single_pass_time * 1000, legacy_time / single_pass_time))
+    print('memoized, cold:          {:.2f} ms ({:.1f}x)'.format(cold_time * 1000, legacy_time / cold_time))
+    print('memoized, warm:          {:.2f} ms ({:.1f}x)'.format(warm_time * 1000, legacy_time / warm_time))
+
+
+if __name__ == '__main__':
+    main(init_args())
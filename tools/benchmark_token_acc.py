@@ -0,0 +1,125 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/31
+
+import os
+import sys
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+import time
+import warnings
+import torch
+from torch.overrides import TorchFunctionMode
+from metrics.token_acc_metrics import TokenAccMetric
+
+HOST_READS = {torch.Tensor.item, torch.Tensor.tolist, torch.Tensor.numpy, torch.Tensor.__bool__,
+              torch.Tensor.__int__, torch.Tensor.__float__}
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='compare the host syncs and time of the token accuracy metrics')
+    parser.add_argument('--num_batches', default=200, type=int)
+    parser.add_argument('--batch_size', default=32, type=int)
+    parser.add_argument('--max_length', default=800, type=int)
+    parser.add_argument('--vocab_size', default=50000, type=int)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu', type=str)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+class LegacyTokenAccMetric:
+    # the former implementation of TokenAccMetric, two host syncs per batch
+    def __init__(self, pad_token_id=0, eos_token_id=2, **kwargs):
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = eos_token_id
+        self.total_tokens = 0
+        self.token_correct = 0
+        self.token_acc = []
+
+    def add(self, tgt_seqs, preds):
+        shape_diff = preds.shape[1] - tgt_seqs.shape[1]
+        if shape_diff < 0:
+            preds = torch.nn.functional.pad(preds, (0, -shape_diff), "constant", self.pad_token_id)
+        elif shape_diff > 0:
+            tgt_seqs = torch.nn.functional.pad(tgt_seqs, (0, shape_diff), "constant", self.pad_token_id)
+        mask = torch.logical_or(tgt_seqs != self.pad_token_id, preds != self.pad_token_id)
+        tok_acc = (preds == tgt_seqs)[mask].float()
+        self.token_acc.append(tok_acc.mean().item())
+        self.token_correct += int(tok_acc.sum().item())
+        self.total_tokens += len(tok_acc)
+
+    def mean(self):
+        return self.token_correct / self.total_tokens
+
+
+class HostReadCounter(TorchFunctionMode):
+    # tensor values read back by python, each one is a sync on a CUDA device
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def __torch_function__(self, func, types, args=(), kwargs=None):
+        if func in HOST_READS:
+            self.count += 1
+        return func(*args, **(kwargs or {}))
+
+
+def make_batches(args):
+    # predictions and labels of different lengths, padded after a random length like generate's output
+    generator = torch.Generator().manual_seed(args.seed)
+    batches = []
+    for _ in range(args.num_batches):
+        pair = []
+        for length in torch.randint(args.max_length // 4, args.max_length, (2,), generator=generator).tolist():
+            seqs = torch.randint(3, args.vocab_size, (args.batch_size, length), generator=generator)
+            lengths = torch.randint(1, length + 1, (args.batch_size, 1), generator=generator)
+            seqs[torch.arange(length).view(1, -1) >= lengths] = 1
+            # most predicted tokens are right
+            pair.append(seqs)
+        preds, labels = pair
+        common = min(preds.shape[1], labels.shape[1])
+        keep = torch.rand(preds.shape[0], common, generator=generator) < .9
+        preds[:, :common] = torch.where(keep, labels[:, :common], preds[:, :common])
+        batches.append((preds.to(args.device), labels.to(args.device)))
+    return batches
+
+
+def run(metric, batches, device):
+    counter = HostReadCounter()
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    with warnings.catch_warnings(record=True) as syncs, counter:
+        if device.startswith('cuda'):
+            # counts the syncs hidden in ops as well, like boolean mask indexing
+            warnings.simplefilter('always')
+            torch.cuda.set_sync_debug_mode('warn')
+        for preds, labels in batches:
+            metric.add(preds, labels)
+        add_time = time.perf_counter() - start
+        mean = metric.mean()
+        if device.startswith('cuda'):
+            torch.cuda.set_sync_debug_mode('default')
+    total_time = time.perf_counter() - start
+    num_syncs = len(syncs) if device.startswith('cuda') else counter.count
+    return mean, num_syncs, add_time, total_time
+
+
+def main(args):
+    batches = make_batches(args)
+    legacy = run(LegacyTokenAccMetric(pad_token_id=1), batches, args.device)
+    current = run(TokenAccMetric(pad_token_id=1), batches, args.device)
+    assert abs(legacy[0] - current[0]) < 1e-12, 'token accuracy differs: {} vs {}'.format(legacy[0], current[0])
+
+    sync_name = 'device syncs' if args.device.startswith('cuda') else 'host reads'
+    print('{} batches of {}x{} on {}, token_acc {:.6f}'.format(args.num_batches, args.batch_size, args.max_length,
+                                                               args.device, current[0]))
+    for name, (_, num_syncs, add_time, total_time) in [('legacy', legacy), ('on device', current)]:
+        print('{:10s} {}: {:5d}, add: {:.2f} ms, add + mean: {:.2f} ms'.format(
+            name, sync_name, num_syncs, add_time * 1000, total_time * 1000))
+
+
+if __name__ == '__main__':
+    main(init_args())
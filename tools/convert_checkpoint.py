@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/29
+
+import os
+import sys
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+import torch
+from base.driver import logger
+from base.torch_utils.checkpoint_util import load_checkpoint, save_sharded_checkpoint
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='convert a .pth/.ckpt checkpoint to sharded safetensors')
+    parser.add_argument('--checkpoint', required=True, type=str, help='.pth model or .ckpt resume checkpoint')
+    parser.add_argument('--output_dir', default=None, type=str,
+                        help='defaults to the checkpoint path without its extension')
+    parser.add_argument('--max_shard_size', default=2 << 30, type=int, help='bytes per model shard')
+    parser.add_argument('--verify', action='store_true', help='load the converted checkpoint back and compare')
+    return parser.parse_args()
+
+
+def _assert_equal(expected, converted, key=''):
+    if isinstance(expected, torch.Tensor):
+        assert torch.equal(expected, converted), '{} differs'.format(key)
+    elif isinstance(expected, dict):
+        assert expected.keys() == converted.keys(), '{} keys differ'.format(key)
+        for k in expected:
+            _assert_equal(expected[k], converted[k], '{}.{}'.format(key, k))
+    elif isinstance(expected, (list, tuple)):
+        assert len(expected) == len(converted), '{} lengths differ'.format(key)
+        for i, (e, c) in enumerate(zip(expected, converted)):
+            _assert_equal(e, c, '{}.{}'.format(key, i))
+
+
+def main(args):
+    output_dir = args.output_dir or os.path.splitext(args.checkpoint)[0]
+    # memory-mapped, the tensors are read from the file as they are written out
+    checkpoint = torch.load(args.checkpoint, map_location=torch.device('cpu'), mmap=True)
+    save_sharded_checkpoint(checkpoint, output_dir, args.max_shard_size)
+    logger.info('converted {} to {}'.format(args.checkpoint, output_dir))
+    if args.verify:
+        if 'model_state_dict' not in checkpoint:
+            checkpoint = {'model_state_dict': checkpoint}
+        # values that went to trainer_state.json come back as json types
+        converted = load_checkpoint(output_dir)
+        for key, value in checkpoint.items():
+            if isinstance(value, dict):
+                _assert_equal(value, converted[key], key)
+        logger.info('verified {}'.format(output_dir))
+
+
+if __name__ == '__main__':
+    main(init_args())
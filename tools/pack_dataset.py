@@ -0,0 +1,37 @@
+# -*- coding:utf-8 -*-
+# create: 2024/8/22
+
+import os
+import sys
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+from transformers import AutoTokenizer
+from mydatasets import pack_nougat_dataset
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='pack a formula dataset for PackedNougatDataset')
+    parser.add_argument('--data_root', nargs='+', required=True, type=str, help='directories of *.png images')
+    parser.add_argument('--equations', required=True, type=str, help='math.txt with one equation per line')
+    parser.add_argument('--output_dir', required=True, type=str)
+    parser.add_argument('--pretrained_model_name_or_path', default='facebook/nougat-base', type=str,
+                        help='tokenizer to pack the token ids with, must be the one used for training')
+    parser.add_argument('--shard_size', default=1024, type=int, help='image shard size in MB')
+    parser.add_argument('--max_dimensions', nargs=2, default=[1024, 512], type=int, help='width height')
+    parser.add_argument('--min_dimensions', nargs=2, default=[32, 32], type=int, help='width height')
+    return parser.parse_args()
+
+
+def main(args):
+    tokenizer = AutoTokenizer.from_pretrained(args.pretrained_model_name_or_path)
+    pack_nougat_dataset(args.data_root, args.equations, tokenizer, args.output_dir,
+                        shard_bytes=args.shard_size << 20,
+                        max_dimensions=tuple(args.max_dimensions),
+                        min_dimensions=tuple(args.min_dimensions))
+
+
+if __name__ == '__main__':
+    main(init_args())